@@ -36,6 +36,17 @@ function(regression TEST_SCRIPT EXECUTABLE SOURCE_DIRECTORY BUILD_DIRECTORY TEST
     set(PLOT_FLAG "-p")
   endif()
 
+  set(FAIL_FAST_FLAG "")
+  if(CTEST_FAIL_FAST)
+    set(FAIL_FAST_FLAG "-f")
+  endif()
+
+  set(TOLERANCE_PROFILE_FLAG "")
+  if(CTEST_TOLERANCE_PROFILE)
+    file(TO_NATIVE_PATH "${CTEST_TOLERANCE_PROFILE}" TOLERANCE_PROFILE)
+    set(TOLERANCE_PROFILE_FLAG "-tolerance-profile" "${TOLERANCE_PROFILE}")
+  endif()
+
   add_test(
     ${TESTNAME} ${PYTHON_EXECUTABLE}
        ${TEST_SCRIPT}
@@ -47,6 +58,8 @@ function(regression TEST_SCRIPT EXECUTABLE SOURCE_DIRECTORY BUILD_DIRECTORY TEST
        ${CMAKE_SYSTEM_NAME}             # [Darwin,Linux,Windows]
        ${CMAKE_Fortran_COMPILER_ID}     # [Intel,GNU]
        ${PLOT_FLAG}                     # empty or "-p"
+       ${FAIL_FAST_FLAG}                # empty or "-f"
+       ${TOLERANCE_PROFILE_FLAG}        # empty or "-tolerance-profile" and the profile path
   )
   # limit each test to 90 minutes: 5400s
   set_tests_properties(${TESTNAME} PROPERTIES TIMEOUT 5400 WORKING_DIRECTORY "${CMAKE_CURRENT_BINARY_DIR}" LABELS "${LABEL}")
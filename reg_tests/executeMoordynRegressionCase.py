@@ -52,6 +52,8 @@ parser.add_argument("compilerId", metavar="Compiler-Id", type=str, nargs=1, help
 parser.add_argument("-p", "-plot", dest="plot", default=False, metavar="Plotting-Flag", type=bool, nargs="?", help="bool to include matplotlib plots in failed cases")
 parser.add_argument("-n", "-no-exec", dest="noExec", default=False, metavar="No-Execution", type=bool, nargs="?", help="bool to prevent execution of the test cases")
 parser.add_argument("-v", "-verbose", dest="verbose", default=False, metavar="Verbose-Flag", type=bool, nargs="?", help="bool to include verbose system output")
+parser.add_argument("-f", "-fail-fast", dest="failFast", action='store_true', help="bool to stop at the first failing channel without writing the case report")
+parser.add_argument("-tolerance-profile", dest="toleranceProfile", default=None, metavar="Tolerance-Profile", type=str, help="JSON file with per case and per channel tolerances and exclusions")
 
 args = parser.parse_args()
 
@@ -66,6 +68,8 @@ tolerance = args.tolerance[0]
 plotError = args.plot if args.plot is False else True
 noExec = args.noExec if args.noExec is False else True
 verbose = args.verbose if args.verbose is False else True
+failFast = args.failFast
+toleranceProfile = args.toleranceProfile
 
 # validate inputs
 rtl.validateExeOrExit(executable)
@@ -114,31 +118,25 @@ baselineOutFile = os.path.join(targetOutputDirectory, "driver.MD.out")
 rtl.validateFileOrExit(localOutFile)
 rtl.validateFileOrExit(baselineOutFile)
 
-testData, testInfo, testPack = pass_fail.readFASTOut(localOutFile, MD = True)
-baselineData, baselineInfo, _ = pass_fail.readFASTOut(baselineOutFile, MD = True )
-performance = pass_fail.calculateNorms(testData, baselineData)
-normalizedNorm = performance[:, 1]
+# the failure history orders the fail-fast scan; run without fail-fast for the full report
+failureHistory = os.path.join(testBuildDirectory, "failing_channels.txt")
+performance, testInfo, tolerance, passing, failing = pass_fail.compareCase(localOutFile, baselineOutFile, caseName, tolerance, toleranceProfile, failFast, failureHistory, MD = True)
+if failFast:
+    sys.exit(0 if passing else 1)
 
-# export all case summaries
+# export all case summaries, with plots of the failing channels
 results = list(zip(testInfo["attribute_names"], [*performance]))
 results_max = performance.max(axis=0)
-exportCaseSummary(testBuildDirectory, caseName, results, results_max, tolerance)
+plots = []
+if not passing and plotError:
+    from errorPlotting import plotOpenfastErrors
+    failChannels = [channel for channel, fails in zip(testInfo["attribute_names"], failing) if fails]
+    plots = plotOpenfastErrors(localOutFile, baselineOutFile, failChannels, MD = True)
+exportCaseSummary(testBuildDirectory, caseName, results, results_max, tolerance, plots)
 
 # failing case
-if not pass_fail.passRegressionTest(normalizedNorm, tolerance):
-    if plotError:
-        from errorPlotting import finalizePlotDirectory, plotOpenfastError
-        ixFailChannels = [i for i in range(len(testInfo["attribute_names"])) if normalizedNorm[i] > tolerance]
-        failChannels = [channel for i, channel in enumerate(testInfo["attribute_names"]) if i in ixFailChannels]
-        failResults = [res for i, res in enumerate(results) if i in ixFailChannels]
-        for channel in failChannels:
-            try:
-                plotOpenfastError(localOutFile, baselineOutFile, channel, MD = True)
-            except:
-                error = sys.exc_info()[1]
-                print("Error generating plots: {}".format(error.msg))
-        finalizePlotDirectory(localOutFile, failChannels, caseName)
+if not passing:
     sys.exit(1)
-    
+
 # passing case
 sys.exit(0)
\ No newline at end of file
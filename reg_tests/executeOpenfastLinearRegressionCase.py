@@ -70,6 +70,8 @@ parser.add_argument("compilerId", metavar="Compiler-Id", type=str, nargs=1, help
 parser.add_argument("-p", "-plot", dest="plot", default=False, metavar="Plotting-Flag", type=bool, nargs="?", help="bool to include plots in failed cases")
 parser.add_argument("-n", "-no-exec", dest="noExec", default=False, metavar="No-Execution", type=bool, nargs="?", help="bool to prevent execution of the test cases")
 parser.add_argument("-v", "-verbose", dest="verbose", default=False, metavar="Verbose-Flag", type=bool, nargs="?", help="bool to include verbose system output")
+parser.add_argument("-f", "-fail-fast", dest="failFast", action='store_true', help="accepted for consistency with the other cases; the linearization comparison always stops at the first mismatch")
+parser.add_argument("-tolerance-profile", dest="toleranceProfile", default=None, metavar="Tolerance-Profile", type=str, help="JSON file with per case tolerances; channel settings do not apply to linearization outputs")
 
 args = parser.parse_args()
 
@@ -83,6 +85,10 @@ compilerId = args.compilerId[0]
 plotError = args.plot if args.plot is False else True
 noExec = args.noExec if args.noExec is False else True
 verbose = args.verbose if args.verbose is False else True
+toleranceProfile = args.toleranceProfile
+
+# linearization outputs have no channels, so only the case tolerance of the profile applies
+tolerance, _ = pass_fail.readTolerances(toleranceProfile, caseName, None, tolerance)
 
 # validate inputs
 rtl.validateExeOrExit(executable)
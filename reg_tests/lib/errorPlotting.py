@@ -23,13 +23,21 @@
 """
 
 import os
+import re
 import sys
+import html
+import json
 import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 
 import rtestlib as rtl
-from fast_io import load_output
+from fast_io import load_output_channels, load_output_info, ChannelIndex
+from pass_fail import alignTimeSeries
 
 def _validateAndExpandInputs(argv):
     rtl.validateInputOrExit(argv, 3, "solution1 solution2 attribute")
@@ -40,97 +48,206 @@ def _validateAndExpandInputs(argv):
     rtl.validateFileOrExit(baselineSolution)
     return (testSolution, baselineSolution, attribute)
 
-def _parseSolution(solution, MD = False):
+def _parseSolutionInfo(solution, MD = False):
     try:
-        data, info, _ = load_output(solution, MD)
-        return (data, info)
+        return load_output_info(solution, MD)
     except Exception as e:
         rtl.exitWithError("Error: {}".format(e))
 
+def _parseSolutionChannels(solution, attributes, MD = False):
+    try:
+        return load_output_channels(solution, attributes, MD)
+    except Exception as e:
+        rtl.exitWithError("Error: {}".format(e))
+
+# samples kept per plotted series; about two per pixel of the plot width
+MAX_PLOT_POINTS = 2000
+
+def _decimate(xseries, yseries, max_points = MAX_PLOT_POINTS):
+    """
+    Reduce a series to at most about max_points samples by keeping the
+    minimum and maximum of each of max_points / 2 equal buckets, plus the
+    first and last samples, so peaks and spikes survive the decimation.
+    """
+    n = yseries.size
+    if n <= max_points:
+        return xseries, yseries
+    nbuckets = max_points // 2
+    bucket = -(-n // nbuckets)
+    # pad with the last sample so the buckets fill a rectangular array
+    padded = np.empty(nbuckets * bucket)
+    padded[:n] = yseries
+    padded[n:] = yseries[-1]
+    padded = padded.reshape(nbuckets, bucket)
+    offsets = np.arange(nbuckets) * bucket
+    # NaN samples, drawn as gaps, are kept only where a bucket has nothing else
+    nan = np.isnan(padded)
+    ix = np.concatenate((
+        [0, n - 1],
+        offsets + np.argmin(np.where(nan, np.inf, padded), axis=1),
+        offsets + np.argmax(np.where(nan, -np.inf, padded), axis=1),
+    ))
+    ix = np.unique(np.minimum(ix, n - 1))
+    return xseries[ix], yseries[ix]
+
 def _plotError(xseries, y1series, y2series, xlabel, title1, title2):
-    from bokeh.embed import components
+    from bokeh.embed import json_item
     from bokeh.layouts import gridplot
     from bokeh.plotting import figure
     from bokeh.models.tools import HoverTool, BoxZoomTool
 
+    # the error is taken at full resolution; each line is then decimated on its own
+    error = abs(y2series - y1series)
+    x2, y2series = _decimate(xseries, y2series)
+    x1, y1series = _decimate(xseries, y1series)
+    xerror, error = _decimate(xseries, error)
+
     p1 = figure(title=title1)
     p1.title.align = 'center'
     p1.grid.grid_line_alpha=0.3
     p1.xaxis.axis_label = 'Time (s)'
-    p1.line(xseries, y2series, color='green', line_width=3, legend_label='Baseline')
-    p1.line(xseries, y1series, color='red', line_width=1, legend_label='Local')
+    p1.line(x2, y2series, color='green', line_width=3, legend_label='Baseline')
+    p1.line(x1, y1series, color='red', line_width=1, legend_label='Local')
     p1.add_tools(HoverTool(tooltips=[('Time','@x'), ('Value', '@y')],mode='vline'))
 
     p2 = figure(title=title2, x_range=p1.x_range)
     p2.title.align = 'center'
     p2.grid.grid_line_alpha = 0
     p2.xaxis.axis_label = 'Time (s)'
-    p2.line(xseries, abs(y2series - y1series), color='blue')
+    p2.line(xerror, error, color='blue')
     p2.add_tools(HoverTool(tooltips=[('Time','@x'), ('Error', '@y')], mode='vline'))
 
     grid = gridplot([[p1, p2]], plot_width=650, plot_height=375, sizing_mode="scale_both")
-    script, div = components(grid)
     
-    return script, div
-
-def _replace_id_div(html_string, plot):
-    id_start = html_string.find('id=') + 4
-    id_end = html_string[id_start:].find('"') + id_start
-    html_string = plot.join((html_string[:id_start], html_string[id_end:]))
-    return html_string
-
-def _replace_id_script(html_string, plot):
-    id_start = html_string.find('var render_items')    
-    id_start += html_string[id_start:].find('roots')    
-    id_start += html_string[id_start:].find('":"') + 3    
-    id_end = html_string[id_start:].find('"') + id_start
-    html_string = plot.join((html_string[:id_start], html_string[id_end:]))
-    return html_string
-
-def _save_plot(script, div, path, attribute):
-    div_class = ' class="col-sm-12 col-md-6 col-lg-6"'
-
-    file_name = "_script".join((attribute, ".txt"))
-    with open(os.path.join(path, file_name), 'w') as f:
-        script = _replace_id_script(script.replace('\n', '\n  '), attribute)
-        f.write(script)
-    
-    file_name = "_div".join((attribute, ".txt"))
-    with open(os.path.join(path, file_name), 'w') as f:
-        div = _replace_id_div(div, attribute)
-        ix_insert = div.find('></div>')
-        div = div_class.join((div[:ix_insert], div[ix_insert:]))
-        style = 'style="margin:10 auto"'
-        div = div.replace("<div", " ".join(("<div", style)))
-        f.write(div)
+    # a JSON document embedded by the case page only when the channel is opened
+    return json.dumps(json_item(grid))
 
 def plotOpenfastError(testSolution, baselineSolution, attribute, MD = False):
+    """
+    Plot one channel of a test and baseline solution. Returns the
+    (attribute, item) plot for exportCaseSummary, where item is the Bokeh
+    JSON document of the plot.
+    """
     testSolution, baselineSolution, attribute = _validateAndExpandInputs([
         testSolution, baselineSolution, attribute
     ])
-    dict1, info1 = _parseSolution(testSolution, MD)
-    dict2, info2 = _parseSolution(baselineSolution, MD)
+    dict1, info1 = _parseSolutionChannels(testSolution, [attribute], MD)
+    dict2, info2 = _parseSolutionChannels(baselineSolution, [attribute], MD)
+    try:
+        dict1, dict2, _ = alignTimeSeries(dict1, dict2)
+    except ValueError as e:
+        rtl.exitWithError("Error: {}".format(e))
+    unit = ChannelIndex.from_info(info1).unit(attribute)
+    item = _renderChannel(dict1[:, 0], dict1[:, 1], dict2[:, 1], attribute, unit)
+    return (attribute, item)
+
+# plotOpenfastErrors uses a worker process per this many channels by default
+PLOT_CHANNELS_PER_WORKER = 16
+
+def plotOpenfastErrors(testSolution, baselineSolution, attributes, MD = False, max_workers = None):
+    """
+    Plot each of the given channels of a test and baseline solution like
+    plotOpenfastError, reading each solution once for all channels. Solutions
+    covering different times are plotted on the times they share, as in
+    pass_fail.alignTimeSeries.
+
+    The plots are rendered in a pool of max_workers processes, by default
+    one per PLOT_CHANNELS_PER_WORKER channels and at most the cpu count.
+    The workers read the channels from a temporary memory mapped .npy file
+    rather than receiving pickled copies, and the plots are returned in
+    channel order. The case scripts have no __main__ guard, so workers are
+    only forked; where fork is not available, or the pool breaks, the plots
+    are rendered serially.
 
+    A channel that cannot be plotted is reported and skipped. Returns the
+    (attribute, item) plots for exportCaseSummary.
+    """
+    rtl.validateFileOrExit(testSolution)
+    rtl.validateFileOrExit(baselineSolution)
+    index = ChannelIndex.from_info(_parseSolutionInfo(testSolution, MD))
+    baselineIndex = ChannelIndex.from_info(_parseSolutionInfo(baselineSolution, MD))
+    plotted = []
+    for attribute in attributes:
+        if attribute not in index or attribute not in baselineIndex:
+            print("Error generating plots: Invalid channel name--{}".format(attribute))
+    attributes = [attribute for attribute in attributes if attribute in index and attribute in baselineIndex]
+    if not attributes:
+        return plotted
+
+    dict1, info1 = _parseSolutionChannels(testSolution, attributes, MD)
+    dict2, info2 = _parseSolutionChannels(baselineSolution, attributes, MD)
+    # a run that ends early or uses a different output step is plotted on the shared times
     try:
-        channel = info1['attribute_names'].index(attribute)
-    except Exception as e:
-        rtl.exitWithError("Error: Invalid channel name--{}".format(e))
+        dict1, dict2, _ = alignTimeSeries(dict1, dict2)
+    except ValueError as e:
+        print("Error generating plots: {}".format(e))
+        return plotted
+    units = [index.unit(attribute) for attribute in attributes]
+
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, len(attributes) // PLOT_CHANNELS_PER_WORKER)
+    context = _forkContext()
+    if max_workers <= 1 or context is None:
+        rendered = (
+            _renderChannelSafely(dict1[:, 0], dict1[:, i + 1], dict2[:, i + 1], attribute, units[i])
+            for i, attribute in enumerate(attributes)
+        )
+        _collectPlots(rendered, attributes, plotted)
+        return plotted
+
+    # channel major, so each worker reads contiguous series from the map
+    fd, sharedPath = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(testSolution)))
+    os.close(fd)
+    try:
+        np.save(sharedPath, np.stack((dict1.T, dict2.T)))
+        del dict1, dict2
+        jobs = [(sharedPath, i + 1, attribute, units[i]) for i, attribute in enumerate(attributes)]
+        try:
+            with ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+                rendered = list(executor.map(_renderSharedChannel, jobs))
+        except BrokenProcessPool as e:
+            print("Error generating plots in parallel, rendering serially: {}".format(e))
+            rendered = map(_renderSharedChannel, jobs)
+        _collectPlots(rendered, attributes, plotted)
+    finally:
+        os.remove(sharedPath)
+    return plotted
 
-    title1 = attribute + " (" + info1["attribute_units"][channel] + ")"
+def _forkContext():
+    # spawned or forkserver workers would import and re-run the calling case script
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+def _renderChannel(timevec, y1series, y2series, attribute, unit):
+    title1 = attribute + " (" + unit + ")"
     title2 = "Max norm"
     xlabel = 'Time (s)'
 
-    timevec = dict1[:, 0]
-    y1series = np.array(dict1[:, channel], dtype = np.float)
-    y2series = np.array(dict2[:, channel], dtype = np.float)
-    script, div = _plotError(timevec, y1series, y2series, xlabel, title1, title2)
+    y1series = np.array(y1series, dtype = np.float64)
+    y2series = np.array(y2series, dtype = np.float64)
+    return _plotError(timevec, y1series, y2series, xlabel, title1, title2)
 
-    basePath = os.path.sep.join(testSolution.split(os.path.sep)[:-1])
-    plotPath = os.path.join(basePath, "plots")
-    rtl.validateDirOrMkdir(plotPath)
-    _save_plot(script, div, plotPath, attribute)
-    
-def _htmlHead(title):
+def _renderChannelSafely(timevec, y1series, y2series, attribute, unit):
+    try:
+        return _renderChannel(timevec, y1series, y2series, attribute, unit), None
+    except Exception as e:
+        return None, str(e)
+
+def _renderSharedChannel(job):
+    sharedPath, column, attribute, unit = job
+    data = np.load(sharedPath, mmap_mode='r')
+    return _renderChannelSafely(np.array(data[0, 0]), data[0, column], data[1, column], attribute, unit)
+
+def _collectPlots(rendered, attributes, plotted):
+    for attribute, (plot, error) in zip(attributes, rendered):
+        if error is not None:
+            print("Error generating plots: {}".format(error))
+            continue
+        plotted.append((attribute, plot))
+
+def _htmlHead(title, scripts = ()):
     head  = '<!DOCTYPE html>' + '\n'
     head += '<html>' + '\n'
     head += '<head>' + '\n'
@@ -145,6 +262,7 @@ def _htmlHead(title):
     head += '  <script src="https://cdn.pydata.org/bokeh/release/bokeh-1.2.0.min.js"></script>' + '\n'
     head += '  <script src="https://cdn.pydata.org/bokeh/release/bokeh-widgets-1.2.0.min.js"></script>' + '\n'
     head += '  <script type="text/javascript"> Bokeh.set_log_level("info"); </script>' + '\n'
+    head += ''.join('  {}\n'.format(script.strip().replace('\n', '\n  ')) for script in scripts)
     
     head += '  <style media="screen" type="text/css">'
     head += '    .cell-warning {'
@@ -172,41 +290,6 @@ def _tableHead(columns):
     head += '      </thead>' + '\n'
     return head
 
-def finalizePlotDirectory(test_solution, plot_list, case):
-    base_path = os.path.sep.join(test_solution.split(os.path.sep)[:-1])
-    plot_path = os.path.join(base_path, "plots")
-
-    with open(os.path.join(base_path, '.'.join((case, 'html'))), 'r') as html:
-        html = html.read()
-        script_ix = html.rfind('</script>\n') + len('</script>\n')
-
-        for i, plot in enumerate(plot_list):
-            _path = os.path.join(plot_path, plot + '_div.txt')
-            with open(_path, 'r') as f:
-                div = f.read().strip().join(('      ', '\n'))
-            html = ''.join((html, div))
-
-        html = ''.join((html, '    </div>' + '\n'))
-        html = ''.join((html, '  </div>' + '\n'))
-        html = ''.join((html, '</body>' + '\n'))
-        html = ''.join((html, _htmlTail()))
-
-    for i, plot in enumerate(plot_list):
-        _path = os.path.join(plot_path, f'{plot}_script.txt')
-        with open(_path, "r") as f:
-            _s = f.read()
-        if i == 0:
-            script = _s
-        else:
-            script = ''.join((script, _s))
-        
-    shutil.rmtree(plot_path, ignore_errors=True)
-
-    script = ''.join((script, '\n'))
-    html = script.join((html[:script_ix], html[script_ix:]))
-    with open(os.path.join(base_path, '.'.join((case, 'html'))), 'w') as f:
-        f.write(html)
-    
 def exportResultsSummary(path, results):
     with open(os.path.join(path, "regression_test_summary.html"), "w") as html:
         
@@ -243,47 +326,129 @@ def exportResultsSummary(path, results):
         html.write( _htmlTail() )
     html.close()
     
-def exportCaseSummary(path, case, results, results_max, tolerance):
-    with open(os.path.join(path, case+".html"), "w") as html:
-        html.write( _htmlHead(case + " Summary") )
+# the plots of a case page are written to this directory next to the page
+PLOT_DIRECTORY = "plots"
+
+# loads a plot the first time its channel is opened, from the table row or the #channel link;
+# the sidecars are script files so that the page also works when opened from disk
+_PLOT_LOADER = """<script type="text/javascript">
+  (function() {{
+    var plotFiles = {};
+    var requested = {{}};
+    window.ofRegisterPlot = function(attribute, item) {{
+      Bokeh.embed.embed_item(item, "plot-" + attribute);
+    }};
+    function showPlot(attribute) {{
+      if (!plotFiles.hasOwnProperty(attribute) || requested[attribute]) return;
+      requested[attribute] = true;
+      var script = document.createElement("script");
+      script.src = plotFiles[attribute];
+      document.head.appendChild(script);
+    }}
+    function showHash() {{
+      showPlot(decodeURIComponent(window.location.hash.slice(1)));
+    }}
+    window.addEventListener("hashchange", showHash);
+    document.addEventListener("DOMContentLoaded", function() {{
+      showHash();
+      document.addEventListener("click", function(event) {{
+        var row = event.target.closest("tr[data-channel]");
+        if (row) showPlot(row.getAttribute("data-channel"));
+      }});
+    }});
+  }})();
+</script>"""
+
+def _plotFile(attribute):
+    # channel names may hold characters that do not belong in file names or urls
+    return re.sub(r'[^\w.-]', '_', attribute) + ".js"
+
+def _plotDiv(attribute):
+    return ('      <div id="{0}" class="col-sm-12 col-md-6 col-lg-6" style="margin:10 auto">\n'
+            '        <a href="#{0}">{0}</a>\n'
+            '        <div id="plot-{0}"></div>\n'
+            '      </div>\n').format(html.escape(attribute))
+
+def _writePlotFiles(directory, plots):
+    """
+    Write each (attribute, item) plot to its own script in directory and
+    return the file of each channel relative to the case page.
+    """
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    files = {}
+    if not plots:
+        return files
+    os.makedirs(directory)
+    for attribute, item in plots:
+        name = _plotFile(attribute)
+        # sanitized names can collide, e.g. "a/b" and "a_b"
+        if name in files.values():
+            name = "{}_{}".format(len(files), name)
+        with open(os.path.join(directory, name), "w") as f:
+            f.write("ofRegisterPlot({}, {});\n".format(json.dumps(attribute), item))
+        files[attribute] = name
+    return {attribute: PLOT_DIRECTORY + "/" + name for attribute, name in files.items()}
+
+def exportCaseSummary(path, case, results, results_max, tolerance, plots = ()):
+    """
+    Write the case page: the norms of every channel and, below them, a
+    placeholder for each of the (attribute, item) plots of plotOpenfastErrors.
+
+    The plots are not part of the page. Each is written to its own file in
+    PLOT_DIRECTORY and is only loaded and rendered when its channel is
+    opened, so the page opens at the same speed however many channels fail.
+    The page is streamed to the file in one pass.
+    """
+    plots = list(plots)
+    plotFiles = _writePlotFiles(os.path.join(path, PLOT_DIRECTORY), plots)
+    with open(os.path.join(path, case+".html"), "w") as page:
+        loader = _PLOT_LOADER.format(json.dumps(plotFiles).replace("</", "<\\/"))
+        page.write( _htmlHead(case + " Summary", [loader] if plots else []) )
         
-        html.write('<body>\n')
-        html.write('  <h2 class="text-center">{}</h2>\n'.format(case + " Summary"))
-        html.write('  <h4 class="text-center">Maximum values for each norm are <span class="cell-warning">highlighted</span> and failing norms (norm >= {0}) are <span class="cell-highlight">highlighted</span></h2>\n'.format(tolerance))
-        html.write('  <div class="container">\n')
+        page.write('<body>\n')
+        page.write('  <h2 class="text-center">{}</h2>\n'.format(case + " Summary"))
+        tolerances = np.broadcast_to(tolerance, (len(results),))
+        threshold = tolerance if np.ndim(tolerance) == 0 else "channel tolerance"
+        page.write('  <h4 class="text-center">Maximum values for each norm are <span class="cell-warning">highlighted</span> and failing norms (norm >= {0}) are <span class="cell-highlight">highlighted</span></h2>\n'.format(threshold))
+        page.write('  <div class="container">\n')
         
         data = [
-            ('<a href="#{0}">{0}</a>'.format(attribute), *norms)
+            (attribute, '<a href="#{0}">{0}</a>'.format(html.escape(attribute)), *norms)
             for attribute, *norms in results
         ]
         cols = [
             'Channel', 'Relative Max Norm',
             'Relative L2 Norm', 'Infinity Norm'
         ]
-        table = _tableHead(cols)
+        page.write(_tableHead(cols))
         
-        body = '      <tbody>' + '\n'
+        page.write('      <tbody>' + '\n')
         for i, d in enumerate(data):
-            body += '        <tr>' + '\n'
-            body += '          <th scope="row">{}</th>'.format(i+1) + '\n'
-            body += '          <td>{0:s}</td>'.format(d[0]) + '\n'
+            if d[0] in plotFiles:
+                row = '        <tr data-channel="{}" style="cursor: pointer">'.format(html.escape(d[0])) + '\n'
+            else:
+                row = '        <tr>' + '\n'
+            row += '          <th scope="row">{}</th>'.format(i+1) + '\n'
+            row += '          <td>{0:s}</td>'.format(d[1]) + '\n'
             
             fmt = '{0:0.4e}'
-            for j, val in enumerate(d[1]):
+            for j, val in enumerate(d[2]):
                 if val == results_max[j]:
-                    body += ('          <td class="cell-warning">' + fmt + '</td>\n').format(val)
-                elif val > tolerance:
-                    body += ('          <td class="cell-highlight">' + fmt + '</td>\n').format(val)
+                    row += ('          <td class="cell-warning">' + fmt + '</td>\n').format(val)
+                elif val > tolerances[i]:
+                    row += ('          <td class="cell-highlight">' + fmt + '</td>\n').format(val)
                 else:
-                    body += ('          <td>' + fmt + '</td>\n').format(val)
+                    row += ('          <td>' + fmt + '</td>\n').format(val)
             
-            body += '        </tr>' + '\n'
-        body += '      </tbody>' + '\n'
-        table += body
-        table += '    </table>' + '\n'
-        html.write(table)
+            row += '        </tr>' + '\n'
+            page.write(row)
+        page.write('      </tbody>' + '\n')
+        page.write('    </table>' + '\n')
         
-        html.write('    <br>' + '\n')
-        html.write('  </div>' + '\n')
-        html.write('</body>' + '\n')
-        html.write( _htmlTail() )
+        page.write('    <br>' + '\n')
+        for attribute in plotFiles:
+            page.write(_plotDiv(attribute))
+        page.write('  </div>' + '\n')
+        page.write('</body>' + '\n')
+        page.write( _htmlTail() )
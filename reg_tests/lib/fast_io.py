@@ -19,11 +19,18 @@ Created on 03/09/2015
 @author: MMPE
 Copied from https://github.com/WISDEM/AeroelasticSE/tree/openmdao1/src/AeroelasticSE/old_files on 15 Aug 2016 by Ganesh Vijayakumar
 '''
+import io
 import os
+import re
+import json
+import fnmatch
+import hashlib
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import struct
 
-def load_output(filename, MD = False):
+def load_output(filename, MD = False, cache = False, cache_dir = None):
     """
     Load a FAST binary or ascii output file
 
@@ -31,6 +38,12 @@ def load_output(filename, MD = False):
     ----------
     filename : str
         filename
+    cache : bool
+        use the parsed output cache; meant for files that are loaded again
+        unchanged, like baselines, as fresh test outputs only fill it
+    cache_dir : str
+        directory of the parsed output cache; defaults to the
+        OPENFAST_REGTEST_CACHE environment variable and no cache if unset
 
     Returns
     -------
@@ -45,137 +58,772 @@ def load_output(filename, MD = False):
     """
 
     assert os.path.isfile(filename), "File, %s, does not exists" % filename
-    with open(filename, 'r') as f:
-        if "outb" in filename:
-            return load_binary_output(filename)
-        elif "out" in filename:
+    if cache and cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if cache and cache_dir:
+        return _cached_load_output(filename, MD, cache_dir)
+    return _load_output(filename, MD)
+
+def _load_output(filename, MD = False):
+    with open(filename, 'rb') as fid:
+        fmt, _ = detect_format(fid.read(SNIFF_BYTES))
+        fid.seek(0)
+        if fmt == FORMAT_BINARY:
+            return _read_binary_output(fid, filename)
+        f = io.TextIOWrapper(fid)
+        info = _read_ascii_header(f, filename, MD or fmt == FORMAT_MOORDYN)
+        data = _parse_ascii_body(f, filename)
+    return data, info, np.ones(1)
+
+def load_outputs(filenames, MD = False, max_workers = None, cache = False):
+    """
+    Load many FAST binary or ascii output files concurrently
+
+    File reads and the NumPy decoding release the GIL, so a thread pool
+    overlaps the work of, e.g., a test and baseline pair or all outputs of
+    a multi-output case.
+
+    Parameters
+    ----------
+    filenames : list of str
+        filenames
+    max_workers : int
+        number of threads; defaults to one per file up to the cpu count
+    cache : bool or list of bool
+        the cache argument of load_output, for all files or for each file
+
+    Returns
+    -------
+    outputs: list
+        (data, info, pack) tuples as returned by load_output, in the order
+        of filenames
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return []
+    cache = [cache] * len(filenames) if isinstance(cache, bool) else list(cache)
+    if max_workers is None:
+        max_workers = min(len(filenames), os.cpu_count() or 1)
+    if max_workers <= 1:
+        return [load_output(filename, MD, cache = c) for filename, c in zip(filenames, cache)]
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(lambda filename, c: load_output(filename, MD, cache = c), filenames, cache))
+
+FORMAT_BINARY = 'binary'
+FORMAT_ASCII = 'ascii'
+FORMAT_MOORDYN = 'moordyn'
+SNIFF_BYTES = 512
+
+def load_output_info(filename, MD = False):
+    """
+    Read only the header of a FAST binary or ascii output file and return
+    the info dictionary of load_output without decoding any time steps.
+    """
+    with open(filename, 'rb') as fid:
+        fmt, _ = detect_format(fid.read(SNIFF_BYTES))
+        fid.seek(0)
+        if fmt == FORMAT_BINARY:
+            return _binary_info(filename, _read_binary_header(fid))
+        return _read_ascii_header(io.TextIOWrapper(fid), filename, MD or fmt == FORMAT_MOORDYN)
+
+def outputs_identical(filename1, filename2, chunk_size = 1 << 20):
+    """
+    Return True if two FAST output files hold the same data, i.e. are the
+    same byte for byte except for their descriptions and the "generated on
+    <date> at <time> using <version>" stamp.
+
+    Binary files are compared on their header numbers, scaling, channel
+    names and units and packed data; ascii files on their channel name and
+    unit lines and their body. The lengths are compared first and the
+    contents are then compared chunk by chunk, stopping at the first
+    difference. Files that cannot be read are not identical.
+    """
+    try:
+        segments1 = _payload_segments(filename1)
+        segments2 = _payload_segments(filename2)
+    except Exception:
+        return False
+    if [length for _, length in segments1] != [length for _, length in segments2]:
+        return False
+    with open(filename1, 'rb') as f1, open(filename2, 'rb') as f2:
+        for (start1, length), (start2, _) in zip(segments1, segments2):
+            f1.seek(start1)
+            f2.seek(start2)
+            while length > 0:
+                size = min(chunk_size, length)
+                if f1.read(size) != f2.read(size):
+                    return False
+                length -= size
+    return True
+
+def _payload_segments(filename):
+    # (offset, length) byte ranges of a file that outputs_identical compares
+    size = os.path.getsize(filename)
+    fmt, _ = detect_format(filename)
+    with open(filename, 'rb') as f:
+        if fmt == FORMAT_BINARY:
+            header = _read_binary_header(f)
+            start = f.tell()
+            text = 2 * header['LenName'] * (header['NumOutChans'] + 1)
+            # everything up to LenDesc, then from the channel names on
+            return [(0, start - text - header['LenDesc'] - 4), (start - text, size - start + text)]
+        if fmt == FORMAT_MOORDYN:
+            return [(0, size)]
+        header = [f.readline() for _ in range(8)]
+        start = f.tell()
+        names = start - len(header[6]) - len(header[7])
+        return [(names, start - names), (start, size - start)]
+
+def detect_format(source):
+    """
+    Identify a FAST output file from its leading bytes
+
+    Parameters
+    ----------
+    source : str or bytes
+        filename, or the first SNIFF_BYTES bytes of a file that the caller
+        has already read, e.g. when sorting many files before loading them
+
+    Returns
+    -------
+    format: str
+        FORMAT_BINARY, FORMAT_ASCII (8 header lines) or FORMAT_MOORDYN
+        (channel names on the first line)
+    FileID: int
+        the FAST binary FileFmtID, or None for the text formats
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read(SNIFF_BYTES)
+
+    if len(source) >= 2:
+        FileID = int(np.frombuffer(source[:2], np.int16)[0])
+        if FileID in (FileFmtID_WithTime, FileFmtID_WithoutTime, FileFmtID_NoCompressWithoutTime, FileFmtID_ChanLen_In):
+            return FORMAT_BINARY, FileID
+    if b'\0' in source:
+        raise ValueError("Unrecognized FAST output format")
+
+    for line in source.splitlines():
+        tokens = line.split()
+        if tokens:
+            return (FORMAT_MOORDYN if tokens[0].lower() == b'time' else FORMAT_ASCII), None
+    return FORMAT_ASCII, None
+
+# Parsed outputs are cached as .npy sidecars named by a content hash of the
+# source file, so identical baselines share one entry. Small .key files map
+# (path, size, mtime) to an entry so a cache hit needs no hashing, and whole
+# entries are evicted least recently used first once the cache exceeds its
+# size limit.
+CACHE_DIR_ENV = 'OPENFAST_REGTEST_CACHE'
+CACHE_SIZE_ENV = 'OPENFAST_REGTEST_CACHE_MB'
+CACHE_SIZE_DEFAULT = 4096     # MB
+_CACHE_VERSION = 1            # bump when the parsed representation changes
+
+def _sha1(*items):
+    return hashlib.sha1('|'.join(str(item) for item in items).encode()).hexdigest()
+
+def _file_digest(filename, chunk_size = 1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _write_atomic(path, write, mode = 'wb'):
+    # concurrent test processes and loader threads may share the cache; never expose partial files
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def _cache_files(cache_dir, entry):
+    base = os.path.join(cache_dir, entry)
+    return base + '.json', base + '.data.npy', base + '.pack.npy'
+
+def _read_cache_entry(cache_dir, entry, filename):
+    infoFile, dataFile, packFile = _cache_files(cache_dir, entry)
+    try:
+        with open(infoFile) as f:
+            info = json.load(f)
+        data = np.load(dataFile, mmap_mode='r')
+        pack = np.load(packFile, mmap_mode='r')
+        os.utime(infoFile)    # mark as recently used
+    except (OSError, ValueError):
+        return None
+    info['name'] = os.path.splitext(os.path.basename(filename))[0]
+    return data, info, pack
+
+def _write_cache_entry(cache_dir, entry, data, info, pack):
+    infoFile, dataFile, packFile = _cache_files(cache_dir, entry)
+    _write_atomic(dataFile, lambda f: np.save(f, data))
+    _write_atomic(packFile, lambda f: np.save(f, pack))
+    _write_atomic(infoFile, lambda f: json.dump(info, f), 'w')   # written last, marks the entry complete
+
+def _evict_cache(cache_dir, max_bytes, keep):
+    entries = {}
+    keys = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.key'):
+            keys.append(path)
+            continue
+        if not name.endswith(('.json', '.npy')):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        size, used = entries.get(name.split('.')[0], (0, 0))
+        used = max(used, stat.st_mtime) if name.endswith('.json') else used
+        entries[name.split('.')[0]] = (size + stat.st_size, used)
+
+    total = sum(size for size, _ in entries.values())
+    for entry, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        for path in _cache_files(cache_dir, entry):
             try:
-                print(f.readline())
-            except UnicodeDecodeError:
-                return load_binary_output(filename)
-    return load_ascii_output(filename, MD) + (np.ones(1),)
+                os.remove(path)
+            except OSError:
+                pass
+        del entries[entry]
+        total -= size
+
+    # drop index files that point at evicted entries
+    for path in keys:
+        try:
+            with open(path) as f:
+                if f.read().strip() not in entries:
+                    os.remove(path)
+        except OSError:
+            pass
+
+def _cached_load_output(filename, MD, cache_dir):
+    cacheDir = os.path.abspath(cache_dir)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir, exist_ok=True)
+
+    stat = os.stat(filename)
+    key = _sha1(_CACHE_VERSION, os.path.realpath(filename), stat.st_size, stat.st_mtime_ns, MD)
+    keyFile = os.path.join(cacheDir, key + '.key')
+    try:
+        with open(keyFile) as f:
+            entry = f.read().strip()
+    except OSError:
+        entry = _sha1(_CACHE_VERSION, _file_digest(filename), MD)
+        _write_atomic(keyFile, lambda f: f.write(entry), 'w')
+
+    cached = _read_cache_entry(cacheDir, entry, filename)
+    if cached is not None:
+        return cached
+
+    data, info, pack = _load_output(filename, MD)
+    _write_cache_entry(cacheDir, entry, data, info, pack)
+    maxBytes = float(os.environ.get(CACHE_SIZE_ENV, CACHE_SIZE_DEFAULT)) * 2**20
+    _evict_cache(cacheDir, maxBytes, entry)
+    return data, info, pack
+
+def _read_ascii_header(f, filename, MD = False):
+    info = {}
+    info['name'] = os.path.splitext(os.path.basename(filename))[0]
+    if MD:
+        header = [f.readline() for _ in range(2)]
+        info['attribute_names'] = header[0].split()
+        info['attribute_units'] = [unit[1:-1] for unit in header[1].split()]  #removing "()"
+    else:
+        header = [f.readline() for _ in range(8)]
+        info['description'] = header[4].strip()
+        info['attribute_names'] = header[6].split()
+        info['attribute_units'] = [unit[1:-1] for unit in header[7].split()]  #removing "()"
+    return info
+
+def _parse_ascii_rows(lines, filename):
+    return _check_finite(np.loadtxt(lines, dtype=np.float64, comments=None, ndmin=2), filename)
+
+def _iter_ascii_blocks(filename, offset, block_size):
+    with open(filename) as f:
+        f.seek(offset)
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines:
+                break
+            yield _parse_ascii_rows(lines, filename)
+
+def load_output_blocks(filename, block_size = 100000, MD = False):
+    """
+    Read a FAST binary or ascii output file in blocks of time steps
+
+    Parameters
+    ----------
+    filename : str
+        filename
+    block_size : int
+        maximum number of time steps in each block
+
+    Returns
+    -------
+    info: dict
+        info as returned by load_output
+    blocks: generator
+        yields ndarrays of at most block_size rows with Time in column 0,
+        so only one block is held in memory at a time
+    """
+
+    assert os.path.isfile(filename), "File, %s, does not exists" % filename
+    fmt, _ = detect_format(filename)
+    if fmt == FORMAT_BINARY:
+        outb = OutbFile(filename)
+        return outb.info, outb.blocks(block_size)
+    with open(filename) as f:
+        info = _read_ascii_header(f, filename, MD or fmt == FORMAT_MOORDYN)
+        offset = f.tell()
+    return info, _iter_ascii_blocks(filename, offset, block_size)
+
+def _parse_ascii_body(f, filename):
+    """
+    Parse the numeric body of an ascii output file, from the current position
+    of f, into a float64 array in a single pass.
+    """
+    return _check_finite(np.loadtxt(f, dtype=np.float64, comments=None, ndmin=2), filename)
+
+def _check_finite(data, filename):
+    if np.any(np.isnan(data)):
+        raise ValueError("NaN found in test data: {}".format(filename))
+    if np.any(np.isinf(data)):
+        raise ValueError("Infinity found in test data: {}".format(filename))
+    return data
 
 def load_ascii_output(filename, MD = False):
     with open(filename) as f:
-        if MD:
-            info = {}
-            info['name'] = os.path.splitext(os.path.basename(filename))[0]
-            header = [f.readline() for _ in range(2)]
-            info['attribute_names'] = header[0].split()
-            info['attribute_units'] = [unit[1:-1] for unit in header[1].split()]  #removing "()"
-            data = np.array([line.split() for line in f.readlines()], dtype=np.float)
-            if np.any(np.isnan(data)):
-                raise ValueError("NaN found in test data: {}".format(filename))
-            if np.any(np.isinf(data)):
-                raise ValueError("Infinity found in test data: {}".format(filename))
-            return data, info
-        else:
-            info = {}
-            info['name'] = os.path.splitext(os.path.basename(filename))[0]
-            header = [f.readline() for _ in range(8)]
-            info['description'] = header[4].strip()
-            info['attribute_names'] = header[6].split()
-            info['attribute_units'] = [unit[1:-1] for unit in header[7].split()]  #removing "()"
-            data = np.array([line.split() for line in f.readlines()], dtype=np.float)
-            if np.any(np.isnan(data)):
-                raise ValueError("NaN found in test data: {}".format(filename))
-            if np.any(np.isinf(data)):
-                raise ValueError("Infinity found in test data: {}".format(filename))
-            return data, info
-
-def load_binary_output(filename):
+        info = _read_ascii_header(f, filename, MD)
+        data = _parse_ascii_body(f, filename)
+    return data, info
+
+FileFmtID_WithTime = 1    # File identifiers used in FAST
+FileFmtID_WithoutTime = 2
+FileFmtID_NoCompressWithoutTime = 3
+FileFmtID_ChanLen_In = 4
+
+def _read_struct(fid, fields):
+    dtype = np.dtype(fields)
+    buffer = fid.read(dtype.itemsize)
+    if len(buffer) < dtype.itemsize:
+        raise Exception('Could not read header of %s: file is truncated' % fid.name)
+    return np.frombuffer(buffer, dtype)[0]
+
+def _read_binary_header(fid):
+    """
+    Decode the header of a FAST binary output file with structured dtypes,
+    leaving fid positioned at the start of the packed time series.
+    """
+    FileID = int(_read_struct(fid, [('FileID', np.int16)])['FileID'])  # FAST output file format, INT(2)
+
+    if FileID == FileFmtID_WithTime:
+        timeFields = [('TimeScl', np.float64), ('TimeOff', np.float64)]    # The time slopes and offsets for scaling, REAL(8)
+    else:
+        timeFields = [('TimeOut1', np.float64), ('TimeIncr', np.float64)]  # The first time and the time increment, REAL(8)
+    fields = [('NumOutChans', np.int32), ('NT', np.int32)] + timeFields  # The number of output channels and time steps, INT(4)
+    if FileID == FileFmtID_ChanLen_In:
+        fields.insert(0, ('LenName', np.int16))  # Number of characters in channel names and units
+    prefix = _read_struct(fid, fields)
+
+    header = {name: prefix[name].item() for name in prefix.dtype.names}
+    header['FileID'] = FileID
+    header.setdefault('LenName', 10)             # default number of characters per channel name
+    NumOutChans = header['NumOutChans']
+
+    fields = [('LenDesc', np.int32)]             # The number of characters in the description string, INT(4)
+    if FileID != FileFmtID_NoCompressWithoutTime:
+        fields = [
+            ('ColScl', np.float32, (NumOutChans,)),  # The channel slopes for scaling, REAL(4)
+            ('ColOff', np.float32, (NumOutChans,)),  # The channel offsets for scaling, REAL(4)
+        ] + fields
+    scaling = _read_struct(fid, fields)
+    for name in scaling.dtype.names:
+        header[name] = scaling[name]
+    header['LenDesc'] = int(header['LenDesc'])
+
+    LenName = header['LenName']
+    text = _read_struct(fid, [
+        ('DescStr', np.void, header['LenDesc']),                # DescStr converted to ASCII
+        ('ChanName', np.void, LenName * (NumOutChans + 1)),     # ChanName converted to numeric ASCII
+        ('ChanUnit', np.void, LenName * (NumOutChans + 1)),     # ChanUnit converted to numeric ASCII
+    ])
+    header['DescStr'] = text['DescStr'].tobytes().decode('latin-1').strip()
+    names = text['ChanName'].tobytes().decode('latin-1')
+    units = text['ChanUnit'].tobytes().decode('latin-1')
+    header['ChanName'] = [names[i:i + LenName].strip() for i in range(0, len(names), LenName)]
+    header['ChanUnit'] = [units[i:i + LenName].strip()[1:-1] for i in range(0, len(units), LenName)]
+    return header
+
+def load_binary_output(filename, packed = False):
     """
     Ported from ReadFASTbinary.m by Mads M Pedersen, DTU Wind
     Info about ReadFASTbinary.m:
     Author: Bonnie Jonkman, National Renewable Energy Laboratory
     (c) 2012, National Renewable Energy Laboratory
     Edited for FAST v7.02.00b-bjj  22-Oct-2012
-    """
 
-    def fread(fid, n, type):
-        fmt, nbytes = {'uint8': ('B', 1), 'int16':('h', 2), 'int32':('i', 4), 'float32':('f', 4), 'float64':('d', 8)}[type]
-        return struct.unpack(fmt * n, fid.read(nbytes * n))
-    
-    FileFmtID_WithTime = 1    # File identifiers used in FAST
-    FileFmtID_WithoutTime = 2
-    FileFmtID_NoCompressWithoutTime = 3
-    FileFmtID_ChanLen_In = 4
-    
-    with open(filename, 'rb') as fid:
-        FileID = fread(fid, 1, 'int16')[0]       # FAST output file format, INT(2)
-        
-        if FileID == FileFmtID_ChanLen_In:
-            LenName  = fread(fid, 1, 'int16')[0] # Number of characters in channel names and units
-        else:
-            LenName = 10                         # default number of characters per channel name
+    The header is decoded with structured dtypes and the packed time series
+    is read straight from the file into int16/float64 arrays.
 
-        
-        NumOutChans = fread(fid, 1, 'int32')[0]  # The number of output channels, INT(4)
-        NT = fread(fid, 1, 'int32')[0]           # The number of time steps, INT(4)
-        
-        if FileID == FileFmtID_WithTime:
-            TimeScl = fread(fid, 1, 'float64')   # The time slopes for scaling, REAL(8)
-            TimeOff = fread(fid, 1, 'float64')   # The time offsets for scaling, REAL(8)
-        else:
-            TimeOut1 = fread(fid, 1, 'float64')  # The first time in the time series, REAL(8)
-            TimeIncr = fread(fid, 1, 'float64')  # The time increment, REAL(8)
+    With packed=True the float64 expansion is deferred: data is an in-memory
+    OutbFile that scales columns or blocks on request, and pack is its raw
+    int16 (or float64 for FileFmtID_NoCompressWithoutTime) channel array
+    without the time column.
+    """
+    if packed:
+        outb = OutbFile(filename, mmap=False)
+        return outb, outb.info, outb.packedData
+    with open(filename, 'rb') as fid:
+        return _read_binary_output(fid, filename)
 
-        if FileID != FileFmtID_NoCompressWithoutTime:
-            ColScl = fread(fid, NumOutChans, 'float32')  # The channel slopes for scaling, REAL(4)
-            ColOff = fread(fid, NumOutChans, 'float32')  # The channel offsets for scaling, REAL(4)
+def _read_binary_output(fid, filename):
+    header = _read_binary_header(fid)
+    FileID = header['FileID']
+    NumOutChans = header['NumOutChans']
+    NT = header['NT']
 
-        LenDesc = fread(fid, 1, 'int32')[0]          # The number of characters in the description string, INT(4)
-        DescStrASCII = fread(fid, LenDesc, 'uint8')  # DescStr converted to ASCII
-        DescStr = "".join(map(chr, DescStrASCII)).strip()
+    # get the channel time series
+    nPts = NT * NumOutChans                   # number of data points in the file
+    if FileID == FileFmtID_WithTime:
+        PackedTime = np.fromfile(fid, np.int32, NT)  # read the time data
+        cnt = PackedTime.size
+        if cnt < NT:
+            raise Exception('Could not read entire %s file: read %d of %d time values' % (filename, cnt, NT))
 
-        ChanName = []                                     # initialize the ChanName cell array
-        for iChan in range(NumOutChans + 1):
-            ChanNameASCII = fread(fid, LenName, 'uint8')  # ChanName converted to numeric ASCII
-            ChanName.append("".join(map(chr, ChanNameASCII)).strip())
+    if FileID == FileFmtID_NoCompressWithoutTime:
+        PackedData = np.fromfile(fid, np.float64, nPts)  # read the channel data
+    else:
+        PackedData = np.fromfile(fid, np.int16, nPts)    # read the channel data
 
-        ChanUnit = []                                     # initialize the ChanUnit cell array
-        for iChan in range(NumOutChans + 1):
-            ChanUnitASCII = fread(fid, LenName, 'uint8')  # ChanUnit converted to numeric ASCII
-            ChanUnit.append("".join(map(chr, ChanUnitASCII)).strip()[1:-1])
+    cnt = PackedData.size
+    if cnt < nPts:
+        raise Exception('Could not read entire %s file: read %d of %d values' % (filename, cnt, nPts))
 
-        # get the channel time series
-        nPts = NT * NumOutChans                   # number of data points in the file
-        if FileID == FileFmtID_WithTime:
-            PackedTime = fread(fid, NT, 'int32')  # read the time data
-            cnt = len(PackedTime)
-            if cnt < NT:
-                raise Exception('Could not read entire %s file: read %d of %d time values' % (filename, cnt, NT))
-        
-        if FileID == FileFmtID_NoCompressWithoutTime:
-            PackedData = fread(fid, nPts, 'float64')    # read the channel data
-        else:
-            PackedData = fread(fid, nPts, 'int16')    # read the channel data
-            
-        cnt = len(PackedData)
-        if cnt < nPts:
-            raise Exception('Could not read entire %s file: read %d of %d values' % (filename, cnt, nPts))
+    if FileID == FileFmtID_WithTime:
+        time = (PackedTime - header['TimeOff']) / header['TimeScl']
+    else:
+        time = header['TimeOut1'] + header['TimeIncr'] * np.arange(NT)
 
+    # assemble the outputs in place, with time as the first column
+    PackedData = PackedData.reshape(NT, NumOutChans)
+    pack = np.empty((NT, NumOutChans + 1))
+    pack[:, 0] = time
+    pack[:, 1:] = PackedData
     if FileID == FileFmtID_NoCompressWithoutTime:
-        pack = np.array(PackedData).reshape(NT, NumOutChans)
-        data = pack
+        data = pack.copy()
     else:
         # Scale the packed binary to real data
-        pack = np.array(PackedData).reshape(NT, NumOutChans)
-        data = (pack - ColOff) / ColScl
+        data = np.empty_like(pack)
+        data[:, 0] = time
+        np.subtract(PackedData, header['ColOff'].astype(np.float64), out=data[:, 1:])
+        np.divide(data[:, 1:], header['ColScl'].astype(np.float64), out=data[:, 1:])
+
+    return data, _binary_info(filename, header), pack
+
+def _binary_info(filename, header):
+    return {'name': os.path.splitext(os.path.basename(filename))[0],
+            'description': header['DescStr'],
+            'attribute_names': header['ChanName'],
+            'attribute_units': header['ChanUnit']}
+
+class ChannelIndex(object):
+    """
+    Constant time lookup of the column and unit of a channel by name, plus
+    selection of channels by glob (e.g. Blade*Fx) or regular expression.
+    Columns follow info['attribute_names'], where column 0 is Time.
+    """
+
+    def __init__(self, names, units = None):
+        self.names = list(names)
+        self.units = list(units) if units is not None else [''] * len(self.names)
+        self._columns = {}
+        for column, name in enumerate(self.names):
+            self._columns.setdefault(name, column)    # first match, as list.index
+
+    @classmethod
+    def from_info(cls, info):
+        return cls(info['attribute_names'], info['attribute_units'])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def column(self, name):
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise ValueError("Invalid channel name--{}".format(name))
+
+    def unit(self, name):
+        return self.units[self.column(name)]
+
+    def select(self, pattern, regex = False):
+        """Return the columns of the channels matching a glob or regular expression."""
+        if regex:
+            match = re.compile(pattern).search
+        else:
+            match = re.compile(fnmatch.translate(pattern)).match
+        return [column for column, name in enumerate(self.names) if match(name)]
+
+IntMin = -32768.0             # range of the packed int16 channel data
+IntMax = 32767.0
+Int32Min = -2147483648.0      # range of the packed int32 time data
+Int32Max = 2147483647.0
+
+def _pack_columns(values, minimum, maximum, dtype, scale_dtype = np.float32):
+    """
+    Scale each column of values onto the integer range [minimum, maximum]
+    and return the packed array with the slopes and offsets that
+    load_binary_output uses to undo the scaling. These are float32 for the
+    channels and float64 for the time column, as in the FAST header.
+    """
+    ColMin = values.min(axis=0)
+    ColMax = values.max(axis=0)
+    span = (ColMax - ColMin).astype(scale_dtype)
+    ColScl = np.ones_like(span)
+    np.divide(maximum - minimum, span, out=ColScl, where=span > 0)
+    ColOff = (minimum - ColScl.astype(np.float64) * ColMin).astype(scale_dtype)
+
+    packed = values * ColScl.astype(np.float64)
+    packed += ColOff.astype(np.float64)
+    np.rint(packed, out=packed)
+    np.clip(packed, minimum, maximum, out=packed)
+    return packed.astype(dtype), ColScl, ColOff
+
+def write_binary_output(filename, data, info, FileID = FileFmtID_ChanLen_In):
+    """
+    Write a FAST binary output file
+
+    Parameters
+    ----------
+    filename : str
+        filename
+    data : ndarray
+        data values with Time in the first column, as returned by load_output
+    info : dict
+        info with attribute_names, attribute_units and optionally description
+    FileID : int
+        FileFmtID_WithTime packs the time column, FileFmtID_WithoutTime and
+        FileFmtID_ChanLen_In store the first time and a constant increment,
+        and FileFmtID_NoCompressWithoutTime stores the channels as float64
+        instead of scaled int16. Only FileFmtID_ChanLen_In keeps channel
+        names and units longer than 10 characters.
+    """
+    if FileID not in (FileFmtID_WithTime, FileFmtID_WithoutTime, FileFmtID_NoCompressWithoutTime, FileFmtID_ChanLen_In):
+        raise ValueError("Unknown FAST binary FileID: {}".format(FileID))
+
+    data = np.asarray(data, dtype=np.float64)
+    NT, NumOutChans = data.shape[0], data.shape[1] - 1
+    time = data[:, 0]
+    names = list(info['attribute_names'])
+    units = ['({})'.format(unit) for unit in info['attribute_units']]
+    if len(names) != NumOutChans + 1 or len(units) != NumOutChans + 1:
+        raise ValueError("Expected {} channel names and units, including Time".format(NumOutChans + 1))
+
+    fields = [('FileID', np.int16)]
+    values = [FileID]
+    if FileID == FileFmtID_ChanLen_In:
+        LenName = max([10] + [len(s) for s in names + units])
+        fields.append(('LenName', np.int16))
+        values.append(LenName)
+    else:
+        LenName = 10
+    fields += [('NumOutChans', np.int32), ('NT', np.int32)]
+    values += [NumOutChans, NT]
 
     if FileID == FileFmtID_WithTime:
-        time = (np.array(PackedTime) - TimeOff) / TimeScl;
+        PackedTime, TimeScl, TimeOff = _pack_columns(time.reshape(-1, 1), Int32Min, Int32Max, np.int32, np.float64)
+        fields += [('TimeScl', np.float64), ('TimeOff', np.float64)]
+        values += [TimeScl[0], TimeOff[0]]
     else:
-        time = TimeOut1 + TimeIncr * np.arange(NT)
+        TimeIncr = time[1] - time[0] if NT > 1 else 0.0
+        if NT > 1 and not np.allclose(np.diff(time), TimeIncr, rtol=1e-6, atol=0):
+            raise ValueError("Time is not uniformly spaced; use FileFmtID_WithTime")
+        fields += [('TimeOut1', np.float64), ('TimeIncr', np.float64)]
+        values += [time[0] if NT else 0.0, TimeIncr]
 
-    data = np.concatenate([time.reshape(NT, 1), data], 1)
-    pack = np.concatenate([time.reshape(NT, 1), pack], 1)
+    if FileID == FileFmtID_NoCompressWithoutTime:
+        PackedData = data[:, 1:]
+    else:
+        PackedData, ColScl, ColOff = _pack_columns(data[:, 1:], IntMin, IntMax, np.int16)
+        fields += [('ColScl', np.float32, (NumOutChans,)), ('ColOff', np.float32, (NumOutChans,))]
+        values += [ColScl, ColOff]
 
-    info = {'name': os.path.splitext(os.path.basename(filename))[0],
-            'description': DescStr,
-            'attribute_names': ChanName,
-            'attribute_units': ChanUnit}
-    return data, info, pack
+    DescStr = info.get('description', '').encode('latin-1')
+    fields += [
+        ('LenDesc', np.int32),
+        ('DescStr', np.void, len(DescStr)),
+        ('ChanName', np.void, LenName * (NumOutChans + 1)),
+        ('ChanUnit', np.void, LenName * (NumOutChans + 1)),
+    ]
+    values += [
+        len(DescStr),
+        np.void(DescStr),
+        np.void(''.join(s[:LenName].ljust(LenName) for s in names).encode('latin-1')),
+        np.void(''.join(s[:LenName].ljust(LenName) for s in units).encode('latin-1')),
+    ]
+
+    header = np.zeros(1, np.dtype(fields))
+    for (name, *_), value in zip(fields, values):
+        header[name] = value
+
+    with open(filename, 'wb') as fid:
+        header.tofile(fid)
+        if FileID == FileFmtID_WithTime:
+            PackedTime.tofile(fid)
+        np.ascontiguousarray(PackedData).tofile(fid)
+
+def convert_to_binary(filename, outfile = None, MD = False, FileID = FileFmtID_ChanLen_In):
+    """
+    Convert a FAST ascii output file to the binary format. The output file
+    defaults to the same name with the .outb extension.
+    """
+    if outfile is None:
+        outfile = os.path.splitext(filename)[0] + '.outb'
+    data, info, _ = load_output(filename, MD)
+    write_binary_output(outfile, data, info, FileID)
+    return outfile
+
+class OutbFile(object):
+    """
+    Lazy view of a FAST binary output file.
+
+    Only the header is parsed on construction. The packed time series is
+    memory mapped, or read into memory as int16 when mmap is False, and a
+    channel or block of time steps is scaled by the float32 ColScl/ColOff
+    vectors into float64 only when it is requested. Channels are addressed
+    by name or by their column in info['attribute_names'], where column 0 is
+    Time.
+    """
+
+    def __init__(self, filename, mmap = True):
+        with open(filename, 'rb') as fid:
+            self.header = _read_binary_header(fid)
+            offset = fid.tell()
+        self.filename = filename
+        self.mmap = mmap
+        self.info = _binary_info(filename, self.header)
+        self.index = ChannelIndex.from_info(self.info)
+
+        FileID = self.header['FileID']
+        NT = self.header['NT']
+        NumOutChans = self.header['NumOutChans']
+        dtype = np.float64 if FileID == FileFmtID_NoCompressWithoutTime else np.int16
+
+        nBytes = NT * NumOutChans * np.dtype(dtype).itemsize
+        if FileID == FileFmtID_WithTime:
+            nBytes += NT * np.dtype(np.int32).itemsize
+        if os.path.getsize(filename) < offset + nBytes:
+            raise Exception('Could not read entire %s file: expected %d bytes of packed data' % (filename, nBytes))
+
+        self.packedTime = None
+        if FileID == FileFmtID_WithTime:
+            self.packedTime = self._map(np.int32, offset, (NT,))
+            offset += self.packedTime.nbytes
+        self.packedData = self._map(dtype, offset, (NT, NumOutChans))
+
+    def _map(self, dtype, offset, shape):
+        if 0 in shape:
+            return np.empty(shape, dtype)
+        if not self.mmap:
+            return np.fromfile(self.filename, dtype, int(np.prod(shape)), offset=offset).reshape(shape)
+        return np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+    @property
+    def shape(self):
+        return (self.header['NT'], self.header['NumOutChans'] + 1)
+
+    @property
+    def time(self):
+        return self._time(0, self.header['NT'])
+
+    def _time(self, start, stop):
+        # only the requested steps, so streaming blocks never builds the whole vector
+        if self.packedTime is not None:
+            return (self.packedTime[start:stop] - self.header['TimeOff']) / self.header['TimeScl']
+        start, stop, _ = slice(start, stop).indices(self.header['NT'])
+        return self.header['TimeOut1'] + self.header['TimeIncr'] * np.arange(start, stop)
+
+    def column_index(self, channel):
+        if isinstance(channel, str):
+            return self.index.column(channel)
+        return int(channel)
+
+    def _scale(self, packed, columns):
+        data = packed.astype(np.float64)
+        if self.header['FileID'] != FileFmtID_NoCompressWithoutTime:
+            ix = np.asarray(columns) - 1
+            data -= self.header['ColOff'][ix].astype(np.float64)
+            data /= self.header['ColScl'][ix].astype(np.float64)
+        return data
+
+    def block(self, start, stop):
+        """Return all channels of time steps start:stop as a float64 array."""
+        packed = self.packedData[start:stop]
+        data = np.empty((packed.shape[0], packed.shape[1] + 1))
+        data[:, 0] = self._time(start, stop)
+        data[:, 1:] = packed
+        if self.header['FileID'] != FileFmtID_NoCompressWithoutTime:
+            data[:, 1:] -= self.header['ColOff'].astype(np.float64)
+            data[:, 1:] /= self.header['ColScl'].astype(np.float64)
+        return data
+
+    def blocks(self, block_size = 100000):
+        """Yield the scaled data in blocks of at most block_size time steps."""
+        for start in range(0, self.header['NT'], block_size):
+            yield self.block(start, start + block_size)
+
+    def channel(self, channel):
+        """Return one channel, by name or column, as a float64 vector."""
+        column = self.column_index(channel)
+        if column == 0:
+            return self.time
+        return self._scale(self.packedData[:, column - 1], column)
+
+    def channels(self, channels):
+        """Return a (NT, len(channels)) float64 array of the requested channels."""
+        columns = [self.column_index(c) for c in channels]
+        data = np.empty((self.header['NT'], len(columns)))
+        ix = [i for i, c in enumerate(columns) if c != 0]
+        if ix:
+            selected = [columns[i] for i in ix]
+            data[:, ix] = self._scale(self.packedData[:, np.array(selected) - 1], selected)
+        if len(ix) < len(columns):
+            data[:, [i for i, c in enumerate(columns) if c == 0]] = self.time.reshape(-1, 1)
+        return data
+
+    def select(self, pattern, regex = False):
+        """
+        Return the names of the channels matching a glob or regular expression
+        and a float64 array of only those channels.
+        """
+        columns = self.index.select(pattern, regex)
+        return [self.index.names[c] for c in columns], self.channels(columns)
+
+def load_output_channels(filename, channels, MD = False):
+    """
+    Load only the given channels of a FAST output file. The returned data holds
+    Time followed by the requested channels; info describes the whole file.
+    Binary files are read lazily through OutbFile.
+    """
+    assert os.path.isfile(filename), "File, %s, does not exists" % filename
+    if detect_format(filename)[0] == FORMAT_BINARY:
+        outb = OutbFile(filename)
+        return outb.channels(['Time'] + list(channels)), outb.info
+
+    data, info, _ = load_output(filename, MD)
+    index = ChannelIndex.from_info(info)
+    return data[:, [0] + [index.column(channel) for channel in channels]], info
 
 if __name__=="__main__":
     d,i = load_binary_output('Test18.T1.outb')
@@ -0,0 +1,127 @@
+#
+# Copyright 2017 National Renewable Energy Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+    This library provides rainflow cycle counting and damage equivalent loads
+    (DELs) for comparing the fatigue content of output channels.
+"""
+import numpy as np
+
+# channels are processed in blocks of this many to bound the temporaries
+CHANNEL_BLOCK = 32
+
+def turning_points(data):
+    """
+    Return the turning points of each column of data, i.e. its local extremes
+    plus the first and last samples, as a list of 1D arrays. Plateaus count
+    as a single point. A 1D array is treated as one channel.
+
+    Blocks of channels are processed at once: the slope signs are carried
+    over plateaus and a turning point is a sample where the sign changes.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    nsteps, nchannels = data.shape
+    if nsteps < 3:
+        return [data[:, j].copy() for j in range(nchannels)]
+
+    points = []
+    for start in range(0, nchannels, CHANNEL_BLOCK):
+        x = np.ascontiguousarray(data[:, start:start + CHANNEL_BLOCK].T)
+        slope = np.sign(np.diff(x, axis=1)).astype(np.int8)
+        flat = np.flatnonzero((slope == 0).any(axis=1))
+        if flat.size:
+            last = np.where(slope[flat] != 0, np.arange(nsteps - 1, dtype=np.int32), 0)
+            np.maximum.accumulate(last, axis=1, out=last)
+            slope[flat] = np.take_along_axis(slope[flat], last, axis=1)
+
+        turning = np.empty(x.shape, dtype=bool)
+        turning[:, 0] = turning[:, -1] = True
+        np.not_equal(slope[:, 1:], slope[:, :-1], out=turning[:, 1:-1])
+        if flat.size:
+            # leading plateaus have no slope to change from
+            turning[flat, 1:-1] &= slope[flat, :-1] != 0
+        points.extend(np.split(x[turning], np.cumsum(turning.sum(axis=1))[:-1]))
+    return points
+
+def rainflow(points, min_fraction = 1.0 / 64):
+    """
+    Four-point rainflow counting of a sequence of turning points.
+
+    Two consecutive points close a full cycle when their range is no larger
+    than the ranges on either side. The set of closed cycles does not depend
+    on the order in which they are removed, so vectorized passes first remove
+    every non-overlapping closing pair at once. Once a pass closes fewer than
+    min_fraction of the remaining points, the rest goes through the usual
+    stack based counter. The residue is counted as half cycles.
+
+    Returns the cycle ranges and their counts, 1 for full and 0.5 for half
+    cycles.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    full = []
+    while points.size >= 4:
+        ranges = np.abs(np.diff(points))
+        inner = ranges[1:-1]
+        closing = (inner <= ranges[:-2]) & (inner <= ranges[2:])
+        # equal neighbouring ranges can close overlapping pairs; take the first of each run
+        closing[1:] &= ~closing[:-1].copy()
+        ix = np.flatnonzero(closing)
+        if ix.size == 0 or ix.size < min_fraction * points.size:
+            break
+        full.append(inner[ix])
+        keep = np.ones(points.size, dtype=bool)
+        keep[ix + 1] = keep[ix + 2] = False
+        points = points[keep]
+
+    stack = []
+    closed = []
+    for point in points.tolist():
+        stack.append(point)
+        while len(stack) >= 4:
+            inner = abs(stack[-2] - stack[-3])
+            if inner <= abs(stack[-3] - stack[-4]) and inner <= abs(stack[-1] - stack[-2]):
+                closed.append(inner)
+                del stack[-3:-1]
+            else:
+                break
+    full.append(np.array(closed))
+    full = np.concatenate(full)
+    residue = np.abs(np.diff(stack))
+    return np.concatenate((full, residue)), np.concatenate((np.ones(full.size), np.full(residue.size, 0.5)))
+
+def damage_equivalent_load(data, wohler, neq):
+    """
+    Return the damage equivalent load of each column of data,
+
+        DEL = (sum(n_i * S_i**m) / neq)**(1/m)
+
+    where S_i and n_i are the rainflow ranges and counts, m is the Wohler
+    exponent (a scalar or one per channel) and neq the number of equivalent
+    cycles.
+    """
+    points = turning_points(data)
+    wohler = np.broadcast_to(np.asarray(wohler, dtype=np.float64), (len(points),))
+    dels = np.zeros(len(points))
+    for j, p in enumerate(points):
+        ranges, counts = rainflow(p)
+        # scale by the largest range so S**m does not overflow
+        scale = ranges.max() if ranges.size else 0.0
+        if scale > 0:
+            m = wohler[j]
+            dels[j] = scale * (np.dot(counts, (ranges / scale)**m) / neq)**(1 / m)
+    return dels
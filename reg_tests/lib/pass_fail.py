@@ -19,9 +19,17 @@
     for any structured output file generated within the OpenFAST framework.
 """
 import sys, os
+import csv
+import json
+import fnmatch
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from numpy import linalg as LA
-from fast_io import load_output
+from fast_io import load_output, load_outputs, load_output_info, outputs_identical, detect_format, ChannelIndex, OutbFile
+from fast_io import FORMAT_BINARY, FileFmtID_NoCompressWithoutTime
+from fatigue import damage_equivalent_load
 import rtestlib as rtl
 
 def readFASTOut(fastoutput, MD = False):
@@ -30,8 +38,185 @@ def readFASTOut(fastoutput, MD = False):
     except Exception as e:
         rtl.exitWithError("Error: {}".format(e))
 
-def passRegressionTest(norm, tolerance):
-    return True if max(norm) < tolerance else False
+def readFASTOutInfo(fastoutput, MD = False):
+    try:
+        return load_output_info(fastoutput, MD)
+    except Exception as e:
+        rtl.exitWithError("Error: {}".format(e))
+
+def identicalOutputs(test_file, baseline_file):
+    """
+    True if the test output holds the same data as the baseline, ignoring
+    the description and generation stamp, in which case every norm is zero
+    and neither file has to be decoded.
+    """
+    return outputs_identical(test_file, baseline_file)
+
+def zeroNorms(nchannels):
+    """The calculateNorms results of identical outputs."""
+    return np.zeros((nchannels, 3))
+
+def readFASTOuts(fastoutputs, MD = False, cache = False):
+    try:
+        return load_outputs(fastoutputs, MD, cache = cache)
+    except Exception as e:
+        rtl.exitWithError("Error: {}".format(e))
+
+def _interpolate(data, time):
+    # linear interpolation of every channel at once, sharing the indices and weights
+    t = data[:, 0]
+    if t.size == 1:
+        return np.repeat(data, time.size, axis=0)
+    ix = np.clip(np.searchsorted(t, time, side='right') - 1, 0, t.size - 2)
+    weight = np.clip((time - t[ix]) / (t[ix + 1] - t[ix]), 0, 1)
+    weight[weight < 1e-9] = 0           # keep samples that coincide with the grid exact
+    weight[weight > 1 - 1e-9] = 1
+    aligned = data[ix] * (1 - weight).reshape(-1, 1)
+    aligned += data[ix + 1] * weight.reshape(-1, 1)
+    aligned[:, 0] = time
+    return aligned
+
+def alignTimeSeries(test_data, baseline_data):
+    """
+    Put test and baseline outputs on a common time vector (column 0) so
+    they can be compared when a run ends early or uses a different DT_Out.
+
+    The two series are limited to the time range they share, and the finer
+    series is interpolated onto the coarser one's time steps, so no samples
+    are invented on the coarser side.
+
+    Returns the aligned test and baseline data and the fraction of the time
+    span covered by either series that is outside the shared range, so a
+    test that ends early and one that runs past its baseline both count
+    (0 when nothing was cut).
+    """
+    if test_data.shape[1] != baseline_data.shape[1]:
+        raise ValueError("Test and baseline data have different numbers of channels: {} and {}".format(
+            test_data.shape[1], baseline_data.shape[1]))
+    if test_data.shape[0] == 0 or baseline_data.shape[0] == 0:
+        raise ValueError("Test or baseline data has no time steps")
+    test_time, baseline_time = test_data[:, 0], baseline_data[:, 0]
+    if test_data.shape == baseline_data.shape and np.array_equal(test_time, baseline_time):
+        return test_data, baseline_data, 0.0
+
+    # times within a small fraction of a step are treated as equal
+    steps = np.concatenate((np.diff(test_time), np.diff(baseline_time)))
+    eps = 1e-6 * (steps.max() if steps.size else 1.0)
+    start = max(test_time[0], baseline_time[0])
+    stop = min(test_time[-1], baseline_time[-1])
+    if stop < start - eps:
+        raise ValueError("Test ({} to {} s) and baseline ({} to {} s) do not overlap in time".format(
+            test_time[0], test_time[-1], baseline_time[0], baseline_time[-1]))
+
+    span = max(test_time[-1], baseline_time[-1]) - min(test_time[0], baseline_time[0])
+    cut = span - max(stop - start, 0)
+    truncated = cut / span if span > 0 and cut > eps else 0.0
+
+    in_test = (test_time >= start - eps) & (test_time <= stop + eps)
+    in_baseline = (baseline_time >= start - eps) & (baseline_time <= stop + eps)
+    if in_test.sum() <= in_baseline.sum():
+        test = test_data[in_test]
+        return test, _interpolate(baseline_data, test[:, 0]), truncated
+    baseline = baseline_data[in_baseline]
+    return _interpolate(test_data, baseline[:, 0]), baseline, truncated
+
+def alignSolutions(test_data, baseline_data):
+    try:
+        test_data, baseline_data, truncated = alignTimeSeries(test_data, baseline_data)
+    except ValueError as e:
+        rtl.exitWithError("Error: {}".format(e))
+    if truncated > 0:
+        print("Error: test and baseline cover different times; {:.1%} of their time span is not compared".format(truncated))
+    return test_data, baseline_data, truncated
+
+def passRegressionTest(norm, tolerance, mask = None):
+    if mask is None and np.ndim(tolerance) == 0:
+        return True if max(norm) < tolerance else False
+    return not failingChannels(norm, tolerance, mask).any()
+
+def failingChannels(norm, tolerance, mask = None):
+    """
+    Boolean vector of the channels whose norm is not below their tolerance;
+    tolerance may be a scalar or a per channel vector and channels outside
+    mask never fail.
+    """
+    failing = ~(np.asarray(norm) < tolerance)
+    if mask is not None:
+        failing &= mask
+    return failing
+
+def loadToleranceProfile(profile_file):
+    """
+    Read a JSON tolerance profile of the form
+
+        {
+            "tolerance": 1e-5,
+            "channels": {"Wave*": 1e-3},
+            "exclude": ["TwrClrnc*"],
+            "cases": {
+                "5MW_*": {"tolerance": 2e-5, "channels": {"RotPwr": 1e-4}, "exclude": ["GenTq"]}
+            }
+        }
+
+    Every key is optional. Case names and channel names are glob patterns.
+    """
+    with open(profile_file) as f:
+        return json.load(f)
+
+def _profileSections(profile, case):
+    return [profile] + [
+        settings for pattern, settings in profile.get('cases', {}).items()
+        if fnmatch.fnmatchcase(case, pattern)
+    ]
+
+def caseTolerance(profile, case, tolerance):
+    """
+    The base tolerance of a case: the given tolerance, overridden by the
+    profile's "tolerance" and then by that of each matching case.
+    """
+    tolerance = float(tolerance)
+    for section in _profileSections(profile, case):
+        if 'tolerance' in section:
+            tolerance = float(section['tolerance'])
+    return tolerance
+
+def compileTolerances(profile, case, attribute_names, tolerance):
+    """
+    Compile a tolerance profile for one case into a threshold vector and a
+    boolean mask of the checked channels, aligned with attribute_names.
+
+    The base tolerance is that of caseTolerance. Channel patterns are
+    applied after that, global patterns first, so case patterns win.
+    Excluded channels are masked out and get an infinite threshold.
+    """
+    sections = _profileSections(profile, case)
+    index = ChannelIndex(attribute_names)
+    thresholds = np.full(len(attribute_names), caseTolerance(profile, case, tolerance))
+    mask = np.ones(len(attribute_names), dtype=bool)
+    for section in sections:
+        for pattern, value in section.get('channels', {}).items():
+            thresholds[index.select(pattern)] = float(value)
+    for section in sections:
+        for pattern in section.get('exclude', []):
+            mask[index.select(pattern)] = False
+    thresholds[~mask] = np.inf
+    return thresholds, mask
+
+def readTolerances(profile_file, case, attribute_names, tolerance):
+    """
+    Return the tolerance and channel mask for a case: the scalar tolerance
+    and no mask without a profile, or the compiled profile vectors. Without
+    attribute_names only the scalar case tolerance of the profile applies.
+    """
+    if profile_file is None:
+        return tolerance, None
+    try:
+        profile = loadToleranceProfile(profile_file)
+        if attribute_names is None:
+            return caseTolerance(profile, case, tolerance), None
+        return compileTolerances(profile, case, attribute_names, tolerance)
+    except Exception as e:
+        rtl.exitWithError("Error: invalid tolerance profile {}: {}".format(profile_file, e))
 
 def maxnorm(data, axis=0):
     return LA.norm(data, np.inf, axis=axis)
@@ -64,38 +249,579 @@ def calculate_max_norm_over_range(test_data, baseline_data):
 def calculate_max_norm(testData, baselineData):
     return maxnorm(abs(testData - baselineData))
     
-def calculateNorms(test_data, baseline_data):
-    relative_norm = calculate_max_norm_over_range(test_data, baseline_data)
-    max_norm = calculate_max_norm(test_data, baseline_data)
-    relative_l2_norm = calculate_relative_norm(test_data, baseline_data)
-    results = np.hstack((
-        relative_norm.reshape(-1, 1), relative_l2_norm.reshape(-1, 1),
-        max_norm.reshape(-1, 1)
-    ))
-    return results
-    
-if __name__=="__main__":
+class NormAccumulator(object):
+    """
+    Single pass accumulation of the norms in calculateNorms.
+
+    Feed row blocks of the test and baseline data to update(); each block
+    costs one temporary of its own size. The accumulator keeps only per
+    channel vectors: the baseline min and max, the max abs difference and
+    the squared L2 norms of the difference and of the baseline. results()
+    returns the same three column matrix as calculateNorms.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.baseline_min = None
+        self.baseline_max = None
+        self.max_diff = None
+        self.diff_sq = None
+        self.baseline_sq = None
+
+    def update(self, test_block, baseline_block):
+        if test_block.shape != baseline_block.shape:
+            raise ValueError("Test and baseline blocks have different shapes: {} and {}".format(
+                test_block.shape, baseline_block.shape))
+        if test_block.shape[0] == 0:
+            return
+
+        diff = np.subtract(test_block, baseline_block)
+        np.abs(diff, out=diff)
+        stats = (
+            baseline_block.min(axis=0), baseline_block.max(axis=0), diff.max(axis=0),
+            np.einsum('ij,ij->j', diff, diff), np.einsum('ij,ij->j', baseline_block, baseline_block)
+        )
+        if self.count == 0:
+            self.baseline_min, self.baseline_max, self.max_diff, self.diff_sq, self.baseline_sq = stats
+        else:
+            np.minimum(self.baseline_min, stats[0], out=self.baseline_min)
+            np.maximum(self.baseline_max, stats[1], out=self.baseline_max)
+            np.maximum(self.max_diff, stats[2], out=self.max_diff)
+            self.diff_sq += stats[3]
+            self.baseline_sq += stats[4]
+        self.count += test_block.shape[0]
 
-    rtl.validateInputOrExit(sys.argv, 4, "{} test_solution baseline_solution tolerance".format(sys.argv[0]))
+    def results(self):
+        if self.count == 0:
+            raise ValueError("No data was accumulated")
+        max_norm = self.max_diff
 
-    testSolution = sys.argv[1]
-    baselineSolution = sys.argv[2]
-    tolerance = sys.argv[3]
+        # the max abs difference is normalized by the channel range when it is at least 1
+        channel_ranges = np.abs(self.baseline_max - self.baseline_min)
+        relative_norm = max_norm.copy()
+        ix_non_diff = (channel_ranges >= 1)
+        relative_norm[ix_non_diff] = max_norm[ix_non_diff] / channel_ranges[ix_non_diff]
 
+        # the L2 norm of the difference is normalized by the baseline L2 norm when it is at least 1
+        norm_diff = np.sqrt(self.diff_sq)
+        norm_baseline = np.sqrt(self.baseline_sq)
+        relative_l2_norm = norm_diff.copy()
+        ix_non_diff = (norm_baseline >= 1)
+        relative_l2_norm[ix_non_diff] = norm_diff[ix_non_diff] / norm_baseline[ix_non_diff]
+
+        return np.hstack((
+            relative_norm.reshape(-1, 1), relative_l2_norm.reshape(-1, 1),
+            max_norm.reshape(-1, 1)
+        ))
+
+def samePacking(test, baseline):
+    """
+    True if two OutbFile views have the same int16 packing (ColScl and
+    ColOff) and time steps, so their channels can be compared as packed.
+    """
+    test_header, baseline_header = test.header, baseline.header
+    if test_header['FileID'] != baseline_header['FileID'] or test_header['FileID'] == FileFmtID_NoCompressWithoutTime:
+        return False
+    if test.shape != baseline.shape:
+        return False
+    if not (np.array_equal(test_header['ColScl'], baseline_header['ColScl']) and
+            np.array_equal(test_header['ColOff'], baseline_header['ColOff'])):
+        return False
+    return np.array_equal(test.time, baseline.time)
+
+def readPackedFASTOuts(test_file, baseline_file):
+    """
+    Return OutbFile views of a test and baseline binary output that pass
+    samePacking, or None when they have to be compared as floats.
+    """
     try:
-        tolerance = float(tolerance)
-    except ValueError:
-        rtl.exitWithError("Error: invalid tolerance given, {}".format(tolerance))
+        if detect_format(test_file)[0] != FORMAT_BINARY or detect_format(baseline_file)[0] != FORMAT_BINARY:
+            return None
+        test, baseline = OutbFile(test_file), OutbFile(baseline_file)
+    except Exception:
+        # the float path reads the files again and reports the error
+        return None
+    return (test, baseline) if samePacking(test, baseline) else None
+
+def calculatePackedNorms(test, baseline, block_size = 8192):
+    """
+    calculateNorms of two OutbFile views with the same packing, computed on
+    the int16 channels without expanding either file to float64.
+
+    A channel is (packed - ColOff) / ColScl, so its difference is the packed
+    difference divided by ColScl. The max and squared sum of the packed
+    differences and the baseline extremes are exact integer reductions that
+    are rescaled at the end. The baseline squared sum is accumulated around
+    c = round(ColOff): with d = ColOff - c,
+    sum((packed - ColOff)**2) = sum((packed - c)**2) - 2*d*sum(packed - c) + n*d**2.
+    """
+    header = baseline.header
+    scale = header['ColScl'].astype(np.float64)
+    offset = header['ColOff'].astype(np.float64)
+    # offsets of constant channels can be far outside the int16 range; their
+    # squares are then dominated by d**2 and need no centering
+    center = np.where(np.abs(offset) < 2**20, np.round(offset), 0)
+    delta = offset - center
+    center = center.astype(np.int32)
+
+    nsteps, nchannels = baseline.packedData.shape
+    packed_min = np.full(nchannels, np.iinfo(np.int16).max, dtype=np.int64)
+    packed_max = np.full(nchannels, np.iinfo(np.int16).min, dtype=np.int64)
+    max_diff = np.zeros(nchannels, dtype=np.int64)
+    diff_sq = np.zeros(nchannels)
+    centered_sq = np.zeros(nchannels)
+    centered_sum = np.zeros(nchannels)
+    for start in range(0, nsteps, block_size):
+        test_block = test.packedData[start:start + block_size]
+        baseline_block = baseline.packedData[start:start + block_size]
+        np.minimum(packed_min, baseline_block.min(axis=0), out=packed_min)
+        np.maximum(packed_max, baseline_block.max(axis=0), out=packed_max)
+
+        # int16 differences need 17 bits; the sums of squares are exact in int64 for each block
+        diff = np.subtract(test_block, baseline_block, dtype=np.int32)
+        diff_sq += np.einsum('ij,ij->j', diff, diff, dtype=np.int64)
+        np.abs(diff, out=diff)
+        np.maximum(max_diff, diff.max(axis=0), out=max_diff)
+
+        centered = np.subtract(baseline_block, center, dtype=np.int32)
+        centered_sq += np.einsum('ij,ij->j', centered, centered, dtype=np.int64)
+        centered_sum += centered.sum(axis=0, dtype=np.int64)
+
+    baseline_sq = centered_sq - 2 * delta * centered_sum + nsteps * delta**2
+    bounds = ((packed_min - offset) / scale, (packed_max - offset) / scale)
+
+    # the time column is shared by both files
+    time = baseline.time
+    accumulator = NormAccumulator()
+    accumulator.count = nsteps
+    accumulator.baseline_min = np.concatenate(([time.min()], np.minimum(*bounds)))
+    accumulator.baseline_max = np.concatenate(([time.max()], np.maximum(*bounds)))
+    accumulator.max_diff = np.concatenate(([0.0], max_diff / np.abs(scale)))
+    accumulator.diff_sq = np.concatenate(([0.0], diff_sq / scale**2))
+    accumulator.baseline_sq = np.concatenate(([np.dot(time, time)], np.maximum(baseline_sq, 0) / scale**2))
+    return accumulator.results()
+
+# calculateNorms reduces row blocks of about this many values, which keeps
+# the temporaries of wide outputs in cache, and gives each thread at least
+# NORM_COLUMN_BLOCK channels
+NORM_BLOCK_VALUES = 1 << 17
+NORM_COLUMN_BLOCK = 256
+
+def _accumulateNorms(test_data, baseline_data, block_size):
+    accumulator = NormAccumulator()
+    for start in range(0, test_data.shape[0], block_size):
+        accumulator.update(test_data[start:start + block_size], baseline_data[start:start + block_size])
+    return accumulator.results()
 
-    rtl.validateFileOrExit(testSolution)
-    rtl.validateFileOrExit(baselineSolution)
+def calculateNorms(test_data, baseline_data, block_size = None, nthreads = None):
+    """
+    Relative max, relative L2 and infinity norms of every channel, one row
+    per channel.
 
-    testData, testInfo, testPack = readFASTOut(testSolution)
-    baselineData, baselineInfo, basePack = readFASTOut(baselineSolution)
+    Wide outputs are split into contiguous blocks of channels that are
+    reduced in parallel threads; NumPy releases the GIL in the reductions.
+    nthreads defaults to one thread per NORM_COLUMN_BLOCK channels, at most
+    the cpu count. Each block is reduced in row blocks of block_size time
+    steps, by default NORM_BLOCK_VALUES values per block.
+    """
+    if test_data.shape != baseline_data.shape:
+        raise ValueError("Test and baseline data have different shapes: {} and {}".format(
+            test_data.shape, baseline_data.shape))
+    if isinstance(test_data, OutbFile) and isinstance(baseline_data, OutbFile):
+        if samePacking(test_data, baseline_data):
+            return calculatePackedNorms(test_data, baseline_data, block_size or 8192)
+        test_data, baseline_data = test_data.block(0, None), baseline_data.block(0, None)
+
+    nchannels = test_data.shape[1]
+    if nthreads is None:
+        nthreads = min(os.cpu_count() or 1, nchannels // NORM_COLUMN_BLOCK)
+    nthreads = max(1, min(nthreads, nchannels))
+    edges = np.linspace(0, nchannels, nthreads + 1).astype(int)
+    if block_size is None:
+        block_size = max(16, NORM_BLOCK_VALUES // max(1, edges[1]))
+    if nthreads == 1:
+        return _accumulateNorms(test_data, baseline_data, block_size)
+
+    with ThreadPoolExecutor(nthreads) as executor:
+        blocks = executor.map(
+            lambda columns: _accumulateNorms(test_data[:, columns], baseline_data[:, columns], block_size),
+            [slice(start, stop) for start, stop in zip(edges[:-1], edges[1:])])
+        return np.vstack(list(blocks))
+
+def calculateNormsBlocks(test_blocks, baseline_blocks):
+    """
+    Compute the calculateNorms results from matching streams of row blocks,
+    such as the generators returned by fast_io.load_output_blocks.
+    """
+    accumulator = NormAccumulator()
+    for test_block, baseline_block in itertools.zip_longest(test_blocks, baseline_blocks):
+        if test_block is None or baseline_block is None:
+            raise ValueError("Test and baseline data have a different number of time steps")
+        accumulator.update(test_block, baseline_block)
+    return accumulator.results()
     
-    normalizedNorm, maxNorm = pass_fail.calculateNorms(testData, baselineData, tolerance)
-    if passRegressionTest(normalizedNorm, tolerance):
-        sys.exit(0)
+def calculateDELs(test_data, baseline_data, wohler = 10, neq = None):
+    """
+    Compare the fatigue content of test and baseline data through the
+    rainflow damage equivalent load (DEL) of every channel. Unlike the
+    pointwise norms, the DEL is insensitive to phase shifts.
+
+    wohler is the Wohler exponent, a scalar or one per channel, and neq the
+    number of equivalent cycles, by default the baseline time span in
+    seconds (a 1 Hz DEL).
+
+    Returns a (nchannels, 3) array of the test DEL, the baseline DEL and
+    their difference, relative to the baseline DEL when that is at least 1
+    as in calculateNorms.
+    """
+    if test_data.shape != baseline_data.shape:
+        raise ValueError("Test and baseline data have different shapes: {} and {}".format(
+            test_data.shape, baseline_data.shape))
+    if neq is None:
+        neq = max(baseline_data[-1, 0] - baseline_data[0, 0], 1.0) if baseline_data.shape[0] else 1.0
+    test_del = damage_equivalent_load(test_data, wohler, neq)
+    baseline_del = damage_equivalent_load(baseline_data, wohler, neq)
+    diff = np.abs(test_del - baseline_del)
+    ix_non_diff = (baseline_del >= 1)
+    diff[ix_non_diff] /= baseline_del[ix_non_diff]
+    return np.column_stack((test_del, baseline_del, diff))
+
+def compareFiles(test_file, baseline_file, MD = False, wohler = None):
+    """
+    Load, align and compare one test and baseline output. Returns the
+    calculateNorms results, the test info and the truncated time fraction.
+    Identical outputs are not decoded.
+
+    With a Wohler exponent, the relative DEL difference of calculateDELs is
+    appended to the norms as a fourth column.
+    """
+    if identicalOutputs(test_file, baseline_file):
+        info = load_output_info(test_file, MD)
+        performance = zeroNorms(len(info['attribute_names']))
+        if wohler is not None:
+            performance = np.column_stack((performance, np.zeros(len(performance))))
+        return performance, info, 0.0
+    packed = readPackedFASTOuts(test_file, baseline_file)
+    if packed is not None:
+        performance, info, truncated = calculateNorms(*packed), packed[0].info, 0.0
+        if wohler is not None:
+            test_data, baseline_data = (outb.block(0, None) for outb in packed)
+    else:
+        (test_data, info, _), (baseline_data, _, _) = load_outputs([test_file, baseline_file], MD, cache = [False, True])
+        test_data, baseline_data, truncated = alignTimeSeries(test_data, baseline_data)
+        performance = calculateNorms(test_data, baseline_data)
+    if wohler is not None:
+        performance = np.column_stack((performance, calculateDELs(test_data, baseline_data, wohler)[:, 2]))
+    return performance, info, truncated
+
+def _comparePair(pair):
+    case, test_file, baseline_file, MD, wohler = pair
+    try:
+        performance, info, truncated = compareFiles(test_file, baseline_file, MD, wohler)
+        return case, info['attribute_names'], performance, truncated, None
+    except Exception as e:
+        return case, [], np.empty((0, 3 if wohler is None else 4)), np.nan, "{}: {}".format(case, e)
+
+def compare_many(pairs, MD = False, max_workers = None, wohler = None):
+    """
+    Compare many test and baseline outputs in one process with a pool of
+    worker processes
+
+    Parameters
+    ----------
+    pairs : list
+        (test_file, baseline_file) or (case, test_file, baseline_file)
+        tuples; the case defaults to the test file name without extension
+    max_workers : int
+        number of worker processes; defaults to the cpu count
+    wohler : float
+        Wohler exponent of an additional rel_del field with the relative
+        damage equivalent load difference (see calculateDELs)
+
+    Returns
+    -------
+    results: structured ndarray
+        one record per case and channel with fields case, channel, rel_max
+        (relative max norm), rel_l2 (relative L2 norm), inf (infinity norm)
+        and truncated (the fraction of the time span of test and baseline
+        that was not compared). A pair that cannot be compared gets a single record with
+        an empty channel and NaN norms, and its error is printed to stderr.
+    """
+    jobs = []
+    for pair in pairs:
+        if len(pair) == 2:
+            pair = (os.path.splitext(os.path.basename(pair[0]))[0],) + tuple(pair)
+        jobs.append(tuple(pair) + (MD, wohler))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        compared = [_comparePair(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            compared = list(executor.map(_comparePair, jobs, chunksize=max(1, len(jobs) // (4 * max_workers))))
+
+    metrics = ['rel_max', 'rel_l2', 'inf'] + ([] if wohler is None else ['rel_del'])
+    rows = []
+    for case, channels, performance, truncated, error in compared:
+        if error is not None:
+            print("Error: {}".format(error), file=sys.stderr)
+            rows.append((case, '') + (np.nan,) * (len(metrics) + 1))
+        rows.extend((case, channel, *norms, truncated) for channel, norms in zip(channels, performance))
+
+    dtype = np.dtype([
+        ('case', 'U{}'.format(max([1] + [len(r[0]) for r in rows]))),
+        ('channel', 'U{}'.format(max([1] + [len(r[1]) for r in rows]))),
+    ] + [(metric, np.float64) for metric in metrics] + [
+        ('truncated', np.float64),
+    ])
+    return np.array(rows, dtype=dtype)
+
+def _columns(data, columns):
+    # plain arrays are sliced; lazy readers such as fast_io.OutbFile decode only these channels
+    if isinstance(data, np.ndarray):
+        return data[:, columns]
+    return data.channels(columns)
+
+def findFirstFailure(test_data, baseline_data, tolerance, priority = (), mask = None, group_size = 32, block_size = 8192):
+    """
+    Return the column of a channel whose relative L2 norm, as used by
+    passRegressionTest, is at least tolerance, or None when every channel
+    passes. tolerance and mask are as in passRegressionTest.
+
+    Channels are scanned in groups, starting with the columns in priority
+    (e.g. channels that failed before), and each group is scanned in blocks
+    of time steps. The L2 norm of the difference only grows as blocks are
+    added, so the scan stops at the first block that pushes a channel over
+    its threshold without computing the remaining norms.
+    """
+    if test_data.shape != baseline_data.shape:
+        raise ValueError("Test and baseline data have different shapes: {} and {}".format(
+            test_data.shape, baseline_data.shape))
+    nsteps, nchannels = test_data.shape
+    priority = list(dict.fromkeys(c for c in priority if 0 <= c < nchannels))
+    prioritized = set(priority)
+    order = priority + [c for c in range(nchannels) if c not in prioritized]
+    if mask is not None:
+        order = [c for c in order if mask[c]]
+    thresholds = np.broadcast_to(np.asarray(tolerance, dtype=np.float64), (nchannels,))
+
+    for i in range(0, len(order), group_size):
+        columns = order[i:i + group_size]
+        test = _columns(test_data, columns)
+        baseline = _columns(baseline_data, columns)
+
+        # the full baseline norm of each channel fixes the threshold for its accumulated difference
+        norm_baseline = np.sqrt(np.einsum('ij,ij->j', baseline, baseline))
+        norm_baseline[norm_baseline < 1] = 1
+        diff_sq = np.zeros(len(columns))
+        for start in range(0, nsteps, block_size):
+            diff = test[start:start + block_size] - baseline[start:start + block_size]
+            diff_sq += np.einsum('ij,ij->j', diff, diff)
+            failing = np.flatnonzero(~(np.sqrt(diff_sq) / norm_baseline < thresholds[columns]))
+            if failing.size > 0:
+                return columns[failing[0]]
+    return None
+
+def readFailureHistory(history_file, attribute_names):
+    """
+    Return the columns of the channels recorded as failing in history_file,
+    which may be None for no history.
+    """
+    if history_file is None or not os.path.isfile(history_file):
+        return []
+    with open(history_file) as f:
+        failed = [line.strip() for line in f if line.strip()]
+    columns = {name: i for i, name in reversed(list(enumerate(attribute_names)))}
+    return [columns[name] for name in failed if name in columns]
+
+def recordFailingChannels(history_file, attribute_names, failing):
+    """
+    Put the failing channels, given by column or boolean mask, at the front
+    of the failure history so later fail-fast runs check them first. Nothing
+    is recorded when history_file is None.
+    """
+    if history_file is None:
+        return
+    failing = np.asarray(failing)
+    if failing.dtype == bool:
+        failing = np.flatnonzero(failing)
+    names = [attribute_names[c] for c in failing]
+    names += [attribute_names[c] for c in readFailureHistory(history_file, attribute_names)]
+    with open(history_file, 'w') as f:
+        f.writelines(name + '\n' for name in dict.fromkeys(names))
+
+def failFastRegressionTest(test_data, baseline_data, tolerance, attribute_names, history_file, mask = None):
+    """
+    Gate a case on its first failing channel. Returns True if every channel
+    passes; otherwise reports and records the failing channel and returns
+    False without computing the remaining norms.
+    """
+    priority = readFailureHistory(history_file, attribute_names)
+    failing = findFirstFailure(test_data, baseline_data, tolerance, priority, mask)
+    if failing is None:
+        return True
+    recordFailingChannels(history_file, attribute_names, [failing])
+    print("Channel {} exceeds the tolerance {}; run without fail-fast for the full report".format(
+        attribute_names[failing], np.broadcast_to(tolerance, (len(attribute_names),))[failing]))
+    return False
+
+def compareCase(test_file, baseline_file, case, tolerance, profile_file = None, fail_fast = False, history_file = None, MD = False):
+    """
+    Run the regression test of a case script on its test and baseline
+    outputs.
+
+    Outputs with the same data, as in identicalOutputs, have zero norms and
+    only the test header is read. Binary outputs with the same packing are compared on their int16
+    data; anything else is read as floats and aligned on the shared times,
+    a truncated run failing the case. The tolerance is refined by the
+    optional profile. With fail_fast the case stops at its first failing
+    channel, checking the channels of the failure history first, and no
+    norms are returned.
+
+    Returns the norms, the test info, the tolerance (scalar or per channel),
+    whether the case passes and the boolean vector of failing channels.
+    """
+    identical = identicalOutputs(test_file, baseline_file)
+    packed = None if identical else readPackedFASTOuts(test_file, baseline_file)
+    truncated = 0.0
+    if identical:
+        info = readFASTOutInfo(test_file, MD)
+    elif packed is not None:
+        test_data, baseline_data = packed
+        info = test_data.info
+    else:
+        (test_data, info, _), (baseline_data, _, _) = readFASTOuts([test_file, baseline_file], MD, cache = [False, True])
+        test_data, baseline_data, truncated = alignSolutions(test_data, baseline_data)
+
+    tolerance, mask = readTolerances(profile_file, case, info["attribute_names"], tolerance)
+    if fail_fast:
+        passing = identical or failFastRegressionTest(test_data, baseline_data, tolerance, info["attribute_names"], history_file, mask)
+        return None, info, tolerance, passing and not truncated, None
+
+    if identical:
+        performance = zeroNorms(len(info["attribute_names"]))
+    else:
+        performance = calculateNorms(test_data, baseline_data)
+    failing = failingChannels(performance[:, 1], tolerance, mask)
+    recordFailingChannels(history_file, info["attribute_names"], failing)
+    return performance, info, tolerance, not truncated and not failing.any(), failing
+
+OUTPUT_EXTENSIONS = ('.out', '.outb')
+
+def matchOutputs(test_dir, baseline_dir):
+    """
+    Pair the FAST outputs under test_dir with the baseline outputs at the
+    same relative path under baseline_dir.
+
+    Returns (case, test_file, baseline_file) tuples, the case being the
+    relative path without extension, and the test outputs without a
+    baseline.
+    """
+    pairs, unmatched = [], []
+    for root, dirs, files in os.walk(test_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1] not in OUTPUT_EXTENSIONS:
+                continue
+            test_file = os.path.join(root, name)
+            relative = os.path.relpath(test_file, test_dir)
+            baseline_file = os.path.join(baseline_dir, relative)
+            if os.path.isfile(baseline_file):
+                pairs.append((os.path.splitext(relative)[0].replace(os.sep, '/'), test_file, baseline_file))
+            else:
+                unmatched.append(test_file)
+    return pairs, unmatched
+
+def evaluateResults(results, tolerance, profile = None):
+    """
+    Apply the pass/fail criteria of the case scripts to compare_many
+    results. Returns the tolerance and the failing flag of every record;
+    records of cases that could not be compared or that were truncated
+    fail, and channels excluded by the profile never do.
+    """
+    thresholds = np.full(len(results), float(tolerance))
+    mask = np.ones(len(results), dtype=bool)
+    if profile is not None:
+        for case in np.unique(results['case']):
+            rows = np.flatnonzero(results['case'] == case)
+            thresholds[rows], mask[rows] = compileTolerances(profile, case, results['channel'][rows], tolerance)
+    failing = failingChannels(results['rel_l2'], thresholds, mask)
+    failing |= ~(results['truncated'] == 0)
+    return thresholds, failing
+
+def writeResults(output, results, thresholds, failing, fmt = 'json'):
+    """Write the compared records with their tolerance and status as JSON or CSV."""
+    fields = list(results.dtype.names) + ['tolerance', 'passed']
+    records = [
+        list(record.tolist()) + [float(threshold), not bool(fail)]
+        for record, threshold, fail in zip(results, thresholds, failing)
+    ]
+    if fmt == 'csv':
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(fields)
+        writer.writerows(records)
+    else:
+        # NaN and infinity are not valid JSON
+        records = [
+            {k: (None if isinstance(v, float) and not np.isfinite(v) else v) for k, v in zip(fields, record)}
+            for record in records
+        ]
+        json.dump(records, output, indent=2)
+        output.write('\n')
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compares FAST output files to their baselines and reports the norms of every channel.",
+        epilog="The exit code is 0 when every case passes and 1 otherwise.")
+    parser.add_argument("paths", metavar="path", type=str, nargs="+",
+        help="test and baseline files given in pairs, or a test directory and a baseline directory whose outputs are matched by relative path")
+    parser.add_argument("-t", "-tolerance", dest="tolerance", default=1e-5, metavar="Tolerance", type=float, help="tolerance on the relative L2 norm of each channel")
+    parser.add_argument("-tolerance-profile", dest="toleranceProfile", default=None, metavar="Tolerance-Profile", type=str, help="JSON file with per case and per channel tolerances and exclusions")
+    parser.add_argument("-wohler", dest="wohler", default=None, metavar="Wohler-Exponent", type=float, help="also report the relative damage equivalent load difference of each channel for this Wohler exponent")
+    parser.add_argument("-j", "-jobs", dest="jobs", default=None, metavar="Jobs", type=int, help="number of worker processes; defaults to the cpu count")
+    parser.add_argument("-o", "-output", dest="output", default=None, metavar="Output", type=str, help="file for the norms table; defaults to stdout")
+    parser.add_argument("-format", dest="format", default=None, choices=["json", "csv"], help="norms table format; defaults to the output file extension, or json")
+    args = parser.parse_args()
+
+    if len(args.paths) == 2 and all(os.path.isdir(path) for path in args.paths):
+        pairs, unmatched = matchOutputs(*args.paths)
+        for test_file in unmatched:
+            print("Warning: no baseline for {}".format(test_file), file=sys.stderr)
+        if not pairs:
+            rtl.exitWithError("Error: no outputs in {} match those in {}".format(*args.paths))
+    elif len(args.paths) % 2 == 0:
+        # the test paths name the cases, so outputs with the same file name stay apart
+        pairs = [(os.path.splitext(test)[0], test, baseline) for test, baseline in zip(args.paths[0::2], args.paths[1::2])]
+        for path in args.paths:
+            rtl.validateFileOrExit(path)
+    else:
+        rtl.exitWithError("Error: expected test and baseline files in pairs or two directories, got {} paths".format(len(args.paths)))
+
+    profile = None
+    if args.toleranceProfile is not None:
+        try:
+            profile = loadToleranceProfile(args.toleranceProfile)
+        except Exception as e:
+            rtl.exitWithError("Error: invalid tolerance profile {}: {}".format(args.toleranceProfile, e))
+
+    results = compare_many(pairs, max_workers=args.jobs, wohler=args.wohler)
+    thresholds, failing = evaluateResults(results, args.tolerance, profile)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'csv' if args.output is not None and args.output.lower().endswith('.csv') else 'json'
+    if args.output is None:
+        writeResults(sys.stdout, results, thresholds, failing, fmt)
     else:
-        dict1, info1, pack1 = readFASTOut(testSolution)
-        sys.exit(1)
+        with open(args.output, 'w', newline='') as f:
+            writeResults(f, results, thresholds, failing, fmt)
+
+    cases = np.unique(results['case'])
+    failed = np.unique(results['case'][failing])
+    for case in failed:
+        print("Failed: {}".format(case), file=sys.stderr)
+    print("{} of {} cases passed".format(len(cases) - len(failed), len(cases)), file=sys.stderr)
+    sys.exit(1 if len(failed) else 0)